@@ -4,8 +4,10 @@
 
 import logging
 import secrets
+import shlex
 import string
 from typing import List
+from urllib.parse import quote_plus
 
 from charms.mongodb.v0.mongodb import MongoDBConfiguration, MongoDBConnection
 from ops.model import ActiveStatus, BlockedStatus, StatusBase, WaitingStatus
@@ -19,7 +21,7 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 3
+LIBPATCH = 7
 
 
 # path to store mongodb ketFile
@@ -28,6 +30,27 @@ TLS_EXT_PEM_FILE = "/etc/mongodb/external-cert.pem"
 TLS_EXT_CA_FILE = "/etc/mongodb/external-ca.crt"
 TLS_INT_PEM_FILE = "/etc/mongodb/internal-cert.pem"
 TLS_INT_CA_FILE = "/etc/mongodb/internal-ca.crt"
+# unix socket mongod listens on once it finished starting up
+MONGOD_SOCKET = "/tmp/mongodb-27017.sock"
+# mongod writes its PID to the lock file of the data directory on every start
+MONGOD_LOCK_FILE = "/data/db/mongod.lock"
+# minutes after a start during which the liveness check does not fail, as
+# mongod may listen before it finished recovering its data
+MONGOD_STARTUP_GRACE = 10
+
+# scramSHA256IterationCount defaults and lower bound in MongoDB
+DEFAULT_SCRAM_ITERATION_COUNT = 15000
+MIN_SCRAM_ITERATION_COUNT = 5000
+
+# Values of --tlsMode the charm can run mongod with. requireTLS is left out as the charm
+# itself connects to mongod without TLS.
+TLS_MODES = ("preferTLS", "allowTLS")
+DEFAULT_TLS_MODE = "preferTLS"
+# Protocols disabled to enforce a minimum TLS version.
+TLS_DISABLED_PROTOCOLS = {
+    "TLS1_2": "TLS1_0,TLS1_1",
+    "TLS1_3": "TLS1_0,TLS1_1,TLS1_2",
+}
 
 
 logger = logging.getLogger(__name__)
@@ -64,9 +87,43 @@ def get_create_user_cmd(config: MongoDBConfiguration, mongo_path="mongo") -> Lis
     ]
 
 
-def get_mongod_cmd(config: MongoDBConfiguration) -> str:
+def get_mongod_check_cmd(
+    mongo_path="mongo", socket: str = MONGOD_SOCKET, lock_file: str = MONGOD_LOCK_FILE
+) -> str:
+    """Construct the command of the mongod liveness check.
+
+    The check pings mongod over its unix socket, which needs no
+    authentication. A socket that is not newer than the lock file is left
+    over from the previous mongod, e.g. after a SIGKILL, so the check passes
+    until mongod listens again. It also passes during the first
+    MONGOD_STARTUP_GRACE minutes after a start, so mongod is not restarted
+    while it replays the journal.
+    """
+    ping = (
+        f'{mongo_path} --quiet --eval "db.adminCommand({{ping: 1}})" '
+        f"mongodb://{quote_plus(socket)}"
+    )
+    started_recently = f'test -n "$(find {lock_file} -mmin -{MONGOD_STARTUP_GRACE})"'
+    return f"sh -c 'test ! {socket} -nt {lock_file} || {started_recently} || {ping}'"
+
+
+def get_mongod_cmd(
+    config: MongoDBConfiguration,
+    scram_iteration_count: int = DEFAULT_SCRAM_ITERATION_COUNT,
+    tls_mode: str = DEFAULT_TLS_MODE,
+    tls_min_protocol: str = "",
+    tls_ciphers: str = "",
+) -> str:
     """Construct the MongoDB startup command line.
 
+    Args:
+        config: MongoDB Configuration object.
+        scram_iteration_count: cost of the SCRAM-SHA-256 hashes of new passwords.
+        tls_mode: --tlsMode of client connections, one of TLS_MODES.
+        tls_min_protocol: oldest TLS version accepted, a key of TLS_DISABLED_PROTOCOLS,
+            or empty for the mongod default.
+        tls_ciphers: OpenSSL cipher list for TLS 1.2 and older, or empty for the mongod default.
+
     Returns:
         A string representing the command used to start MongoDB.
     """
@@ -79,15 +136,21 @@ def get_mongod_cmd(config: MongoDBConfiguration) -> str:
         # part of replicaset
         f"--replSet={config.replset}",
     ]
+    if scram_iteration_count != DEFAULT_SCRAM_ITERATION_COUNT:
+        cmd.append(f"--setParameter scramSHA256IterationCount={scram_iteration_count}")
     if config.tls_external:
         cmd.extend(
             [
                 f"--tlsCAFile={TLS_EXT_CA_FILE}",
                 f"--tlsCertificateKeyFile={TLS_EXT_PEM_FILE}",
                 # allow non-TLS connections
-                "--tlsMode=preferTLS",
+                f"--tlsMode={tls_mode}",
             ]
         )
+        if tls_min_protocol:
+            cmd.append(f"--tlsDisabledProtocols={TLS_DISABLED_PROTOCOLS[tls_min_protocol]}")
+        if tls_ciphers:
+            cmd.append(f"--setParameter opensslCipherConfig={shlex.quote(tls_ciphers)}")
 
     # internal TLS can be enabled only in external is enabled
     if config.tls_internal and config.tls_external:
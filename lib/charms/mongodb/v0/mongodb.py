@@ -3,7 +3,6 @@
 # See LICENSE file for licensing details.
 
 import logging
-import re
 from dataclasses import dataclass
 from typing import Dict, List, Optional, Set
 from urllib.parse import quote_plus
@@ -29,13 +28,19 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 3
+LIBPATCH = 13
 
 # path to store mongodb ketFile
 logger = logging.getLogger(__name__)
 
 # List of system usernames needed for correct work on the charm.
 CHARM_USERS = ["operator"]
+# Usernames of client relation users.
+RELATION_USER_PATTERN = r"^relation-\d+$"
+# Users authenticated by the subject of their client certificate live in this database.
+EXTERNAL_DB = "$external"
+# Subjects of the x509 users of client relations, which name the relation user.
+X509_RELATION_USER_PATTERN = r"(^|,)CN=relation-\d+(,|$)"
 
 
 @dataclass
@@ -63,7 +68,8 @@ class MongoDBConfiguration:
     @property
     def uri(self):
         """Return URI concatenated from fields."""
-        hosts = ",".join(self.hosts)
+        # Hosts are sorted to keep the URI stable between hooks.
+        hosts = ",".join(sorted(self.hosts))
         # Auth DB should be specified while user connects to application DB.
         auth_source = ""
         if self.database != "admin":
@@ -76,6 +82,29 @@ class MongoDBConfiguration:
             f"{auth_source}"
         )
 
+    def srv_uri(self, service_host: str) -> str:
+        """Return a DNS seed list URI resolving the members from the SRV records of a service.
+
+        The URI does not change when members are added or removed. Drivers
+        look up `_mongodb._tcp.<service_host>` for the members. Options are
+        part of the URI rather than a TXT record, which Kubernetes DNS does
+        not serve. TLS is set explicitly, as `mongodb+srv` enables it by default.
+
+        Args:
+            service_host: fully qualified name of the headless service of the members.
+        """
+        auth_source = ""
+        if self.database != "admin":
+            auth_source = "&authSource=admin"
+        return (
+            f"mongodb+srv://{quote_plus(self.username)}:"
+            f"{quote_plus(self.password)}@"
+            f"{service_host}/{quote_plus(self.database)}?"
+            f"replicaSet={quote_plus(self.replset)}"
+            f"{auth_source}"
+            f"&tls={str(self.tls_external).lower()}"
+        )
+
 
 class NotReadyError(PyMongoError):
     """Raised when not all replica set members healthy or finished initial sync."""
@@ -199,6 +228,31 @@ class MongoDBConnection:
 
         return rs_status_parsed
 
+    def get_replication_lag(self) -> Dict[str, float]:
+        """Get how far each replica set member is behind the primary.
+
+        Returns:
+            A dict of member hostnames to the seconds of lag; members which
+            are not healthy or report no optime are left out.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure, NotReadyError
+        """
+        rs_status = self.client.admin.command("replSetGetStatus")
+        optimes = {
+            self._hostname_from_hostport(member["name"]): member["optimeDate"]
+            for member in rs_status["members"]
+            if member.get("health") == 1 and "optimeDate" in member
+        }
+        primary = self._primary_from_status(rs_status)
+        if primary not in optimes:
+            raise NotReadyError
+
+        return {
+            hostname: (optimes[primary] - optime).total_seconds()
+            for hostname, optime in optimes.items()
+        }
+
     def get_replset_members(self) -> Set[str]:
         """Get a replica set members.
 
@@ -298,6 +352,29 @@ class MongoDBConnection:
             roles=self._get_roles(config),
         )
 
+    def create_x509_user(self, subject: str, config: MongoDBConfiguration):
+        """Create user authenticated by a client certificate with the given subject.
+
+        Grant the same privileges as `create_user` does.
+        """
+        self.client[EXTERNAL_DB].command(
+            "createUser",
+            subject,
+            roles=self._get_roles(config),
+        )
+
+    def update_x509_user(self, subject: str, config: MongoDBConfiguration):
+        """Update grants of the user authenticated by a client certificate."""
+        self.client[EXTERNAL_DB].command(
+            "updateUser",
+            subject,
+            roles=self._get_roles(config),
+        )
+
+    def drop_x509_user(self, subject: str):
+        """Drop user authenticated by a client certificate."""
+        self.client[EXTERNAL_DB].command("dropUser", subject)
+
     def set_user_password(self, username, password: str):
         """Update the password."""
         self.client.admin.command(
@@ -306,6 +383,19 @@ class MongoDBConnection:
             pwd=password,
         )
 
+    def get_scram_iteration_count(self) -> int:
+        """Return the SCRAM-SHA-256 iteration count used to hash new passwords."""
+        return self.client.admin.command("getParameter", 1, scramSHA256IterationCount=1)[
+            "scramSHA256IterationCount"
+        ]
+
+    def set_scram_iteration_count(self, count: int):
+        """Set the SCRAM-SHA-256 iteration count of the member the client is connected to.
+
+        Existing users keep their hashes until their password is set again.
+        """
+        self.client.admin.command("setParameter", 1, scramSHA256IterationCount=count)
+
     @staticmethod
     def _get_roles(config: MongoDBConfiguration) -> List[dict]:
         """Generate roles List."""
@@ -326,15 +416,66 @@ class MongoDBConnection:
         self.client.admin.command("dropUser", username)
 
     def get_users(self) -> Set[str]:
-        """Add a new member to replica set config inside MongoDB."""
-        users_info = self.client.admin.command("usersInfo")
-        return set(
-            [
-                user_obj["user"]
-                for user_obj in users_info["users"]
-                if re.match(r"^relation-\d+$", user_obj["user"])
-            ]
+        """Return names of all relation users.
+
+        Users are filtered by MongoDB, so the reply does not grow with the
+        number of other users in the deployment. Credentials, privileges and
+        custom data are not requested.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        users_info = self.client.admin.command(
+            "usersInfo",
+            1,
+            filter={"user": {"$regex": RELATION_USER_PATTERN}},
+            showCredentials=False,
+            showPrivileges=False,
+        )
+        return set([user_obj["user"] for user_obj in users_info["users"]])
+
+    def get_x509_users(self) -> Set[str]:
+        """Return subjects of all x509 users of client relations.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        users_info = self.client[EXTERNAL_DB].command(
+            "usersInfo",
+            1,
+            filter={"user": {"$regex": X509_RELATION_USER_PATTERN}},
+            showCredentials=False,
+            showPrivileges=False,
         )
+        return set([user_obj["user"] for user_obj in users_info["users"]])
+
+    def get_server_status(self) -> Dict:
+        """Return the serverStatus of the member the client is connected to.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        return self.client.admin.command("serverStatus")
+
+    def get_current_ops(self, query: Dict) -> List[Dict]:
+        """Return in-progress operations of all users matching the query.
+
+        Args:
+            query: $match expression applied to the $currentOp output.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        pipeline = [{"$currentOp": {"allUsers": True}}, {"$match": query}]
+        return list(self.client.admin.aggregate(pipeline))
+
+    def kill_op(self, opid) -> None:
+        """Terminate the operation with the opid.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        self.client.admin.command("killOp", op=opid)
 
     def get_databases(self) -> Set[str]:
         """Return list of all non-default databases."""
@@ -342,6 +483,28 @@ class MongoDBConnection:
         databases = self.client.list_database_names()
         return set([db for db in databases if db not in system_dbs])
 
+    def get_collections(self, database: str) -> List[str]:
+        """Return names of all non-system collections of a database, views excluded."""
+        collections = self.client[database].list_collection_names(filter={"type": "collection"})
+        return [collection for collection in collections if not collection.startswith("system.")]
+
+    def get_index_stats(self, database: str, collection: str) -> List[Dict]:
+        """Return $indexStats of a collection on the member the client is connected to.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        return list(self.client[database][collection].aggregate([{"$indexStats": {}}]))
+
+    def get_collection_stats(self, database: str, collection: str) -> Dict:
+        """Return storage and latency statistics of a collection.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        pipeline = [{"$collStats": {"storageStats": {}, "latencyStats": {}}}]
+        return next(self.client[database][collection].aggregate(pipeline), {})
+
     def drop_database(self, database: str):
         """Drop a non-default database."""
         system_dbs = ("admin", "local", "config")
@@ -364,8 +527,29 @@ class MongoDBConnection:
 
     def primary(self) -> str:
         """Returns primary replica host."""
-        status = self.client.admin.command("replSetGetStatus")
+        return self._primary_from_status(self.client.admin.command("replSetGetStatus"))
+
+    def step_down(self) -> None:
+        """Step down the primary so that a secondary is elected as the new primary.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        self.client.admin.command("replSetStepDown", 60)
+
+    def compact(self, database: str, collection: str) -> Dict:
+        """Rewrite and defragment the data and indexes of a collection.
+
+        Compaction blocks operations on the collection until MongoDB 4.4, so it
+        should be run on secondaries only.
+
+        Raises:
+            ConfigurationError, ConfigurationError, OperationFailure
+        """
+        return self.client[database].command("compact", collection)
 
+    def _primary_from_status(self, status: Dict) -> Optional[str]:
+        """Returns primary replica host from the replica set status."""
         primary = None
         # loop through all members in the replica set
         for member in status["members"]:
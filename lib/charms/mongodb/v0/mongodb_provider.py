@@ -7,18 +7,27 @@ This class creates a user and database for each application relation
 and expose needed information for client connection via fields in
 external relation.
 """
+import hashlib
 import json
 import logging
 import re
+import time
 from collections import namedtuple
-from typing import Optional, Set
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import replace
+from functools import partial
+from typing import Callable, Dict, Optional, Set
 
-from charms.mongodb.v0.helpers import generate_password
+from charms.mongodb.v0.helpers import DEFAULT_SCRAM_ITERATION_COUNT, generate_password
 from charms.mongodb.v0.mongodb import MongoDBConfiguration, MongoDBConnection
-from ops.charm import RelationBrokenEvent, RelationChangedEvent
-from ops.framework import Object
+from charms.tls_certificates_interface.v1.tls_certificates import (
+    CertificateAvailableEvent,
+)
+from cryptography import x509
+from ops.charm import RelationBrokenEvent, RelationChangedEvent, RelationEvent
+from ops.framework import Object, StoredState
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, Relation
-from pymongo.errors import PyMongoError
+from pymongo.errors import OperationFailure, PyMongoError
 
 # The unique Charmhub library identifier, never change it
 LIBID = "4067879ef7dd4261bf6c164bc29d94b1"
@@ -28,7 +37,7 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 3
+LIBPATCH = 13
 
 logger = logging.getLogger(__name__)
 REL_NAME = "database"
@@ -40,6 +49,30 @@ MONGODB_PORT = 27017
 MONGODB_VERSION = "5.0"
 PEER = "database-peers"
 
+# Number of user commands sent concurrently when reconciling all relations.
+# Each command waits for a majority write concern, so running them in
+# parallel over the shared client hides the replication round trips.
+MAX_USER_COMMAND_WORKERS = 8
+# Failed user commands are retried once before giving up.
+USER_COMMAND_ATTEMPTS = 2
+
+# Databases waiting to be dropped, mapped to the time they were orphaned.
+TOMBSTONES_KEY = "database-tombstones"
+LAST_DROP_KEY = "last-database-drop"
+# SCRAM iteration count the passwords of relation users were last hashed with
+SCRAM_ITERATION_COUNT_KEY = "scram-iteration-count"
+
+# MongoDB error codes
+USER_NOT_FOUND = 11
+USER_ALREADY_EXISTS = 51003
+
+# Clients asking for x509 authentication put the CSR of their certificate under this key.
+X509_CSR_KEY = "x509-csr"
+# The subject the CSR must have is shared with clients under this key.
+X509_CSR_SUBJECT_KEY = "x509-csr-subject"
+# Remote application databag keys that define the relation user.
+USER_KEYS = {"database", "extra-user-roles", X509_CSR_KEY}
+
 Diff = namedtuple("Diff", "added changed deleted")
 Diff.__doc__ = """
 A tuple for storing the diff between two data mappings.
@@ -51,14 +84,22 @@ deleted — key that were deleted."""
 class MongoDBProvider(Object):
     """In this class, we manage client database relations."""
 
+    # Hashes of the client databags by relation user, see _save_diff. They are
+    # kept in the unit state, not in the legacy `data` key of the relation, so
+    # saving them triggers no relation-changed event on clients.
+    _relation_state = StoredState()
+
     def __init__(self, charm, substrate="k8s"):
         """Manager of MongoDB client relations."""
         super().__init__(charm, "client-relations")
+        self._relation_state.set_default(databag_hashes={})
         self.charm = charm
         self.substrate = substrate
         self.framework.observe(self.charm.on[REL_NAME].relation_joined, self._on_relation_event)
         self.framework.observe(self.charm.on[REL_NAME].relation_changed, self._on_relation_event)
         self.framework.observe(self.charm.on[REL_NAME].relation_broken, self._on_relation_event)
+        self.framework.observe(self.charm.on.update_status, self._on_update_status)
+        self.framework.observe(self.charm.on.leader_elected, self._on_leader_elected)
 
     def _on_relation_event(self, event):
         """Handle relation joined events.
@@ -90,28 +131,124 @@ class MongoDBProvider(Object):
             self.charm.restart_mongod_service(auth=True)
             self.charm.unit.status = ActiveStatus()
 
-        departed_relation_id = None
-        if type(event) is RelationBrokenEvent:
-            departed_relation_id = event.relation.id
-
         try:
-            self.oversee_users(departed_relation_id, event)
+            self.oversee_relation(event)
         except PyMongoError as e:
             logger.error("Deferring _on_relation_event since: error=%r", e)
             event.defer()
             return
 
+    def _on_update_status(self, event):
+        """Repair users and databases of all relations and drop orphaned databases.
+
+        Relation events only reconcile their own relation, so users changed
+        or dropped outside the charm are repaired here.
+        """
+        if not self.charm.unit.is_leader():
+            return
+        if "db_initialised" not in self.charm.app_peer_data:
+            return
+        if self._get_users_from_relations(None, rel=LEGACY_REL_NAME):
+            return
+
+        for relation in self.model.relations[REL_NAME]:
+            # The TLS relation may have been missing when the client asked.
+            self._request_x509_certificate(relation)
+
+        try:
+            self.rehash_users()
+            self.oversee_users(None, event)
+            self.drop_next_database()
+        except PyMongoError as e:
+            logger.error("Failed to repair relation users: error=%r", e)
+
+    def _on_leader_elected(self, _) -> None:
+        """Request the client certificates again from the new leader.
+
+        Certificates are requested from the unit databag of the leader, so
+        requests made by a former leader are not followed up by this unit.
+        """
+        if not self.charm.unit.is_leader():
+            return
+        if "db_initialised" not in self.charm.app_peer_data:
+            return
+
+        for relation in self.model.relations[REL_NAME]:
+            self._request_x509_certificate(relation)
+
+    def oversee_relation(self, event: RelationEvent) -> None:
+        """Creates, updates or drops the user of the event relation only.
+
+        Users whose database and roles did not change since they were last
+        created or updated are skipped, so no command is sent to MongoDB.
+        Relation changed events that did not touch the database, roles or x509
+        CSR keys of the client databag are skipped without connecting to MongoDB.
+
+        Args:
+            event: relation event.
+        """
+        username = self._get_username_from_relation_id(event.relation.id)
+        stored_fingerprint = self.charm.app_peer_data.get(f"{username}-fingerprint")
+        if stored_fingerprint is not None and not self._user_keys_changed(event):
+            logger.debug("No user changes in relation %s", event.relation.id)
+            self._save_diff(event)
+            return
+
+        with MongoDBConnection(self.charm.mongodb_config) as mongo:
+            if type(event) is RelationBrokenEvent:
+                logger.info("Remove relation user: %s", username)
+                self._drop_user(mongo, username)
+                self._drop_x509_user(mongo, username)
+                self._revoke_x509_certificate(username)
+                self.charm.app_peer_data.pop(f"{username}-fingerprint", None)
+                self._drop_databag_hashes(username)
+                self._schedule_relation_database_drop(event.relation)
+                return
+
+            config = self._get_config(username, None)
+            if config.database is None:
+                # We need to wait for the moment when the provider library
+                # set the database name into the relation.
+                return
+
+            fingerprint = self._get_user_fingerprint(config)
+            if stored_fingerprint == fingerprint:
+                logger.debug("Relation user %s is up to date", username)
+            elif stored_fingerprint is None:
+                logger.info("Create relation user: %s on %s", config.username, config.database)
+                try:
+                    mongo.create_user(config)
+                    self._set_relation(config)
+                except OperationFailure as e:
+                    # The user was created before the fingerprint was stored.
+                    if e.code != USER_ALREADY_EXISTS:
+                        raise
+                    mongo.update_user(config)
+            else:
+                logger.info("Update relation user: %s on %s", config.username, config.database)
+                mongo.update_user(config)
+                self._update_x509_user(mongo, config)
+            self.charm.app_peer_data[f"{username}-fingerprint"] = fingerprint
+
+        self._request_x509_certificate(event.relation)
+
+        if type(event) is RelationChangedEvent:
+            self._save_diff(event)
+
     def oversee_users(self, departed_relation_id: Optional[int], event):
         """Oversees the users of the application.
 
         Function manages user relations by removing, updated, and creating
         users; and dropping databases when necessary.
 
+        It lists all users and databases, so it is run only on start and
+        periodically to repair them; relation events use `oversee_relation`.
+
         Args:
             departed_relation_id: When specified execution of functions
                 makes sure to exclude the users and databases and remove
                 them if necessary.
-            event: relation event.
+            event: the event the function is run in.
 
         When the function is executed in relation departed event, the departed
         relation is still on the list of all relations. Therefore, for proper
@@ -121,39 +258,449 @@ class MongoDBProvider(Object):
             database_users = mongo.get_users()
             relation_users = self._get_users_from_relations(departed_relation_id)
 
-            for username in database_users - relation_users:
-                logger.info("Remove relation user: %s", username)
-                mongo.drop_user(username)
-
-            for username in relation_users - database_users:
-                config = self._get_config(username, None)
-                if config.database is None:
-                    # We need to wait for the moment when the provider library
-                    # set the database name into the relation.
-                    continue
-                logger.info("Create relation user: %s on %s", config.username, config.database)
-                mongo.create_user(config)
-                self._set_relation(config)
-
-            for username in relation_users.intersection(database_users):
-                config = self._get_config(username, None)
-                logger.info("Update relation user: %s on %s", config.username, config.database)
-                mongo.update_user(config)
-                logger.info("Updating relation data according to diff")
-                self._diff(event)
+            self._drop_users(mongo, database_users - relation_users)
+            self._drop_x509_users(mongo, mongo.get_x509_users(), relation_users)
+            self._create_or_update_users(mongo, relation_users, database_users)
 
             if not self.charm.model.config["auto-delete"]:
                 return
 
             database_dbs = mongo.get_databases()
             relation_dbs = self._get_databases_from_relations(departed_relation_id)
-            for database in database_dbs - relation_dbs:
+            self._schedule_database_drops(database_dbs - relation_dbs)
+
+    def drop_next_database(self) -> None:
+        """Drop the database orphaned first, throttled to limit the load.
+
+        Dropping a large database causes an I/O and replication spike, so at
+        most one database is dropped every `auto-delete-interval` seconds and
+        none while a member lags more than `auto-delete-max-lag` seconds
+        behind the primary.
+        """
+        tombstones = self._get_tombstones()
+        if not tombstones or not self.charm.model.config["auto-delete"]:
+            return
+
+        last_drop = float(self.charm.app_peer_data.get(LAST_DROP_KEY, 0))
+        if time.time() - last_drop < self.charm.model.config["auto-delete-interval"]:
+            return
+
+        database = min(tombstones, key=tombstones.get)
+        with MongoDBConnection(self.charm.mongodb_config) as mongo:
+            # A new relation may have requested the database in the meantime.
+            if database not in self._get_databases_from_relations(None):
+                lag = max(mongo.get_replication_lag().values(), default=0)
+                if lag > self.charm.model.config["auto-delete-max-lag"]:
+                    logger.info(
+                        "Postponing dropping database %s, replication lag: %ss", database, lag
+                    )
+                    return
                 logger.info("Drop database: %s", database)
                 mongo.drop_database(database)
+                self.charm.app_peer_data[LAST_DROP_KEY] = str(time.time())
+
+        del tombstones[database]
+        self.charm.app_peer_data[TOMBSTONES_KEY] = json.dumps(tombstones, sort_keys=True)
+
+    def _schedule_database_drops(self, databases: Set[str]) -> None:
+        """Record orphaned databases to be dropped in the background."""
+        tombstones = self._get_tombstones()
+        if databases.issubset(tombstones):
+            return
+
+        for database in databases - tombstones.keys():
+            logger.info("Schedule dropping database: %s", database)
+            tombstones[database] = int(time.time())
+        self.charm.app_peer_data[TOMBSTONES_KEY] = json.dumps(tombstones, sort_keys=True)
+
+    def _get_tombstones(self) -> Dict[str, int]:
+        """Return databases waiting to be dropped."""
+        return json.loads(self.charm.app_peer_data.get(TOMBSTONES_KEY, "{}"))
+
+    def rehash_users(self) -> None:
+        """Hash the passwords of relation users again after the SCRAM iteration count changed.
+
+        MongoDB hashes passwords when they are set, so users keep their former
+        cost until their password is set again, here to the same value. Users
+        are re-hashed once the primary applies the new count.
+        """
+        count = self.charm.scram_iteration_count
+        hashed_count = self.charm.app_peer_data.get(
+            SCRAM_ITERATION_COUNT_KEY, str(DEFAULT_SCRAM_ITERATION_COUNT)
+        )
+        if hashed_count == str(count):
+            return
+
+        with MongoDBConnection(self.charm.mongodb_config) as mongo:
+            if mongo.get_scram_iteration_count() != count:
+                logger.debug("Waiting for the primary to use SCRAM iteration count %d", count)
+                return
+
+            commands = {}
+            for relation in self.model.relations[REL_NAME]:
+                data = relation.data[self.charm.app]
+                if "username" in data and "password" in data:
+                    logger.info("Re-hash password of relation user: %s", data["username"])
+                    commands[data["username"]] = partial(
+                        mongo.set_user_password, data["username"], data["password"]
+                    )
+            self._raise_user_command_failure(self._run_user_commands(commands))
+
+        self.charm.app_peer_data[SCRAM_ITERATION_COUNT_KEY] = str(count)
+
+    def _drop_users(self, mongo: MongoDBConnection, usernames: Set[str]) -> None:
+        """Drop users of departed relations concurrently."""
+        commands = {}
+        for username in usernames:
+            logger.info("Remove relation user: %s", username)
+            commands[username] = partial(self._drop_user, mongo, username)
+
+        failures = self._run_user_commands(commands)
+        for username in commands.keys() - failures.keys():
+            self.charm.app_peer_data.pop(f"{username}-fingerprint", None)
+            self._drop_databag_hashes(username)
+        self._raise_user_command_failure(failures)
+
+    def _drop_x509_users(
+        self, mongo: MongoDBConnection, subjects: Set[str], relation_users: Set[str]
+    ) -> None:
+        """Drop x509 users of departed relations concurrently and revoke their certificates."""
+        commands = {}
+        usernames = {}
+        for subject in subjects:
+            username = re.search(r"(?:^|,)CN=(relation-\d+)(?:,|$)", subject).group(1)
+            if username in relation_users:
+                continue
+            logger.info("Remove x509 user: %s", subject)
+            commands[subject] = partial(self._drop_x509_subject, mongo, subject)
+            usernames[subject] = username
+
+        failures = self._run_user_commands(commands)
+        for subject in commands.keys() - failures.keys():
+            username = usernames[subject]
+            if self.charm.app_peer_data.get(f"{username}-x509-subject") == subject:
+                self.charm.app_peer_data.pop(f"{username}-x509-subject")
+            self._revoke_x509_certificate(username)
+        self._raise_user_command_failure(failures)
+
+    def _create_or_update_users(
+        self, mongo: MongoDBConnection, relation_users: Set[str], database_users: Set[str]
+    ) -> None:
+        """Create missing and update changed relation users concurrently.
+
+        Relation and peer data are read and written in this thread only,
+        workers send the user commands.
+        """
+        commands = {}
+        configs = {}
+        for username in relation_users:
+            config = self._get_config(username, None)
+            if username in database_users:
+                fingerprint = self._get_user_fingerprint(config)
+                if self.charm.app_peer_data.get(f"{username}-fingerprint") == fingerprint:
+                    continue
+                logger.info("Update relation user: %s on %s", config.username, config.database)
+                commands[username] = partial(mongo.update_user, config)
+            elif config.database is not None:
+                logger.info("Create relation user: %s on %s", config.username, config.database)
+                commands[username] = partial(mongo.create_user, config)
+            else:
+                # We need to wait for the moment when the provider library
+                # set the database name into the relation.
+                continue
+            configs[username] = config
+
+        failures = self._run_user_commands(commands)
+        for username in commands.keys() - failures.keys():
+            if username not in database_users:
+                self._set_relation(configs[username])
+            self.charm.app_peer_data[f"{username}-fingerprint"] = self._get_user_fingerprint(
+                configs[username]
+            )
+        self._raise_user_command_failure(failures)
+
+    @staticmethod
+    def _raise_user_command_failure(failures: Dict[str, PyMongoError]) -> None:
+        """Raise the first error of failed user commands, if any."""
+        if failures:
+            logger.error("Failed to reconcile relation users: %s", sorted(failures))
+            raise next(iter(failures.values()))
+
+    def _request_x509_certificate(self, relation: Relation) -> None:
+        """Request a client certificate for the CSR of the relation, if not done yet.
+
+        The request lives in the unit databag of the requesting unit, so it is
+        made again, rather than renewed, when another unit became the leader.
+        """
+        username = self._get_username_from_relation_id(relation.id)
+        csr = relation.data[relation.app].get(X509_CSR_KEY)
+        requested_csr = self.charm.app_peer_data.get(f"{username}-x509-csr")
+        requester = self.charm.app_peer_data.get(f"{username}-x509-requester")
+        if requester != self.charm.unit.name:
+            requested_csr = None
+        if not csr or csr == requested_csr:
+            return
+
+        error = self._get_x509_csr_error(relation, csr)
+        if error is not None:
+            logger.error("Not requesting the client certificate of %s: %s", username, error)
+            self._update_relation_data(
+                relation, {X509_CSR_SUBJECT_KEY: self._get_x509_csr_subject(relation)}
+            )
+            return
+
+        if not self.charm.tls.request_client_certificate(csr, requested_csr):
+            logger.warning("Cannot issue the client certificate of %s without TLS", username)
+            return
+
+        logger.info("Requested client certificate for %s", username)
+        self.charm.app_peer_data[f"{username}-x509-csr"] = csr
+        self.charm.app_peer_data[f"{username}-x509-requester"] = self.charm.unit.name
+
+    def _get_x509_csr_subject(self, relation: Relation) -> str:
+        """Return the subject the CSR of the relation must have."""
+        return f"CN={self._get_username_from_relation_id(relation.id)},O={relation.app.name}"
+
+    def _get_x509_csr_error(self, relation: Relation, csr: str) -> Optional[str]:
+        """Return why the CSR of a client cannot be signed, or None if it can.
+
+        The x509 user is named after the subject, so a CSR naming another
+        subject could impersonate another user, or a replica set member, whose
+        certificates carry the organization of this application. The subject
+        must therefore hold the relation user name and the client application
+        name only, next to the unique identifier the TLS relation adds.
+        Alternative names are not used for clients and are refused.
+        """
+        try:
+            request = x509.load_pem_x509_csr(csr.encode("utf-8"))
+        except ValueError:
+            return "malformed CSR"
+        if not request.is_signature_valid:
+            return "invalid CSR signature"
+        if any(isinstance(e.value, x509.SubjectAlternativeName) for e in request.extensions):
+            return "subject alternative names are not allowed"
+
+        if relation.app.name == self.charm.app.name:
+            return "the organization of the subject is the one of replica set members"
+        attributes = [(attribute.oid, attribute.value) for attribute in request.subject]
+        unique_identifiers = [a for a in attributes if a[0] == x509.NameOID.X500_UNIQUE_IDENTIFIER]
+        names = [a for a in attributes if a[0] != x509.NameOID.X500_UNIQUE_IDENTIFIER]
+        expected_names = {
+            (x509.NameOID.COMMON_NAME, self._get_username_from_relation_id(relation.id)),
+            (x509.NameOID.ORGANIZATION_NAME, relation.app.name),
+        }
+        if len(unique_identifiers) > 1 or len(names) != 2 or set(names) != expected_names:
+            return f"the subject must be {self._get_x509_csr_subject(relation)}"
+        return None
+
+    def set_x509_certificate(self, event: CertificateAvailableEvent) -> bool:
+        """Create the x509 user of a client certificate and share the certificate.
+
+        The user is named after the subject of the certificate and gets the
+        same roles as the relation user, so clients can authenticate with the
+        TLS handshake instead of SCRAM.
+
+        Returns:
+            whether the certificate was requested for a client relation.
+        """
+        relation = self._get_relation_from_csr(event.certificate_signing_request)
+        if relation is None:
+            return False
+        if not self.charm.unit.is_leader():
+            return True
+
+        username = self._get_username_from_relation_id(relation.id)
+        subject = self._get_x509_subject(event.certificate)
+        config = self._get_config(username, relation.data[self.charm.app].get("password"))
+        if config.database is None:
+            logger.debug("Deferring client certificate of %s until database is set", username)
+            event.defer()
+            return True
+
+        try:
+            with MongoDBConnection(self.charm.mongodb_config) as mongo:
+                self._create_x509_user(mongo, subject, config)
+        except OperationFailure as e:
+            if e.code != USER_ALREADY_EXISTS:
+                logger.error("Deferring client certificate of %s since: error=%r", username, e)
+                event.defer()
+                return True
+            # Another relation, or an operator, owns a user of that subject.
+            logger.error("Not sharing the client certificate of %s: %s exists", username, subject)
+            return True
+        except PyMongoError as e:
+            logger.error("Deferring client certificate of %s since: error=%r", username, e)
+            event.defer()
+            return True
+
+        self._update_relation_data(
+            relation,
+            {
+                "x509-username": subject,
+                "x509-certificate": event.certificate,
+                "x509-ca": "\n".join(event.chain) if event.chain else event.ca,
+            },
+        )
+        return True
+
+    @staticmethod
+    def _get_x509_subject(certificate: str) -> str:
+        """Return the certificate subject the way MongoDB names x509 users (RFC 2253)."""
+        subject = x509.load_pem_x509_certificate(certificate.encode("utf-8")).subject
+        # Certificates issued through the TLS relation carry a unique identifier,
+        # which cryptography would print as a dotted OID.
+        return subject.rfc4514_string(
+            {x509.NameOID.X500_UNIQUE_IDENTIFIER: "x500UniqueIdentifier"}
+        )
+
+    def _create_x509_user(
+        self, mongo: MongoDBConnection, subject: str, config: MongoDBConfiguration
+    ) -> None:
+        """Create the x509 user of a relation, replacing one with an older subject.
+
+        Raises:
+            OperationFailure: with the USER_ALREADY_EXISTS code if the relation
+                does not own the existing user of the subject.
+        """
+        stored_subject = self.charm.app_peer_data.get(f"{config.username}-x509-subject")
+        if stored_subject == subject:
+            mongo.update_x509_user(subject, config)
+            return
+
+        if stored_subject is not None:
+            self._drop_x509_user(mongo, config.username)
+
+        logger.info("Create x509 user: %s on %s", subject, config.database)
+        mongo.create_x509_user(subject, config)
+        self.charm.app_peer_data[f"{config.username}-x509-subject"] = subject
+
+    def _update_x509_user(self, mongo: MongoDBConnection, config: MongoDBConfiguration) -> None:
+        """Update grants of the x509 user of a relation, if it has one."""
+        subject = self.charm.app_peer_data.get(f"{config.username}-x509-subject")
+        if subject is not None:
+            mongo.update_x509_user(subject, config)
+
+    def _drop_x509_user(self, mongo: MongoDBConnection, username: str) -> None:
+        """Drop the x509 user of a relation, if it has one."""
+        subject = self.charm.app_peer_data.get(f"{username}-x509-subject")
+        if subject is None:
+            return
+
+        logger.info("Remove x509 user: %s", subject)
+        self._drop_x509_subject(mongo, subject)
+        self.charm.app_peer_data.pop(f"{username}-x509-subject")
+
+    def _revoke_x509_certificate(self, username: str) -> None:
+        """Revoke the client certificate requested for a relation, if any."""
+        csr = self.charm.app_peer_data.pop(f"{username}-x509-csr", None)
+        self.charm.app_peer_data.pop(f"{username}-x509-requester", None)
+        if csr is not None:
+            self.charm.tls.revoke_client_certificate(csr)
+
+    def expire_x509_certificate(self, certificate: str) -> bool:
+        """Replace a client certificate that is about to expire.
+
+        Certificates are issued for the CSR of the client, whose private key
+        the charm does not have. A new CSR the client already sent is
+        requested right away. Otherwise the certificate is revoked and removed
+        from the relation, so that the client sends a new CSR; the certificate
+        the client has keeps working until it expires.
+
+        Returns:
+            whether the certificate was issued for a client relation.
+        """
+        relation = self._get_relation_from_certificate(certificate)
+        if relation is None:
+            return False
+        if not self.charm.unit.is_leader():
+            return True
+
+        username = self._get_username_from_relation_id(relation.id)
+        csr = relation.data[relation.app].get(X509_CSR_KEY)
+        if csr and csr != self.charm.app_peer_data.get(f"{username}-x509-csr"):
+            logger.info("Client certificate of %s expiring, requesting its new CSR", username)
+            self._request_x509_certificate(relation)
+            return True
+
+        logger.warning("Client certificate of %s expiring, waiting for a new CSR", username)
+        self._revoke_x509_certificate(username)
+        for key in ("x509-certificate", "x509-ca"):
+            relation.data[self.charm.app].pop(key, None)
+        return True
+
+    @staticmethod
+    def _drop_user(mongo: MongoDBConnection, username: str) -> None:
+        """Drop the user if it exists."""
+        try:
+            mongo.drop_user(username)
+        except OperationFailure as e:
+            if e.code != USER_NOT_FOUND:
+                raise
+
+    @staticmethod
+    def _drop_x509_subject(mongo: MongoDBConnection, subject: str) -> None:
+        """Drop the x509 user of the subject if it exists."""
+        try:
+            mongo.drop_x509_user(subject)
+        except OperationFailure as e:
+            if e.code != USER_NOT_FOUND:
+                raise
+
+    @staticmethod
+    def _run_user_commands(commands: Dict[str, Callable[[], None]]) -> Dict[str, PyMongoError]:
+        """Run user commands concurrently, retrying the failed ones.
+
+        Args:
+            commands: user commands by username.
+
+        Returns:
+            The errors of commands which still failed after the last attempt,
+            by username.
+        """
+        failures = {}
+        pending = commands
+        for _ in range(USER_COMMAND_ATTEMPTS):
+            failures = {}
+            with ThreadPoolExecutor(max_workers=MAX_USER_COMMAND_WORKERS) as executor:
+                futures = {
+                    executor.submit(command): username for username, command in pending.items()
+                }
+                for future in as_completed(futures):
+                    error = future.exception()
+                    if error is None:
+                        continue
+                    if not isinstance(error, PyMongoError):
+                        raise error
+                    logger.warning("User command for %s failed: %r", futures[future], error)
+                    failures[futures[future]] = error
+            if not failures:
+                break
+            pending = {username: commands[username] for username in failures}
+
+        return failures
+
+    def _schedule_relation_database_drop(self, relation: Relation) -> None:
+        """Schedule dropping the database of a departed relation if no other relation uses it."""
+        if not self.charm.model.config["auto-delete"]:
+            return
+
+        database = self._get_database_from_relation(relation)
+        if database is None or database in self._get_databases_from_relations(relation.id):
+            return
+        self._schedule_database_drops({database})
+
+    @staticmethod
+    def _get_user_fingerprint(config: MongoDBConfiguration) -> str:
+        """Return a digest of the user settings granted by the relation."""
+        settings = f"{config.database}:{','.join(sorted(config.roles))}"
+        return hashlib.sha256(settings.encode("utf-8")).hexdigest()
 
     def _diff(self, event: RelationChangedEvent) -> Diff:
         """Retrieves the diff of the data in the relation changed databag.
 
+        The diff is computed against the hashes of the databag values saved by
+        the last `_save_diff` call, so nothing is written here.
+
         Args:
             event: relation changed event.
 
@@ -161,32 +708,79 @@ class MongoDBProvider(Object):
             a Diff instance containing the added, deleted and changed
                 keys from the event relation databag.
         """
-        # TODO import marvelous unit tests in a future PR
-        # Retrieve the old data from the data key in the application relation databag.
-        old_data = json.loads(event.relation.data[self.charm.model.app].get("data", "{}"))
-        # Retrieve the new data from the event relation databag.
-        new_data = {
-            key: value for key, value in event.relation.data[event.app].items() if key != "data"
-        }
+        old_hashes = self._get_databag_hashes(event.relation)
+        new_hashes = self._hash_databag(event.relation.data[event.app])
 
         # These are the keys that were added to the databag and triggered this event.
-        added = new_data.keys() - old_data.keys()
+        added = new_hashes.keys() - old_hashes.keys()
         # These are the keys that were removed from the databag and triggered this event.
-        deleted = old_data.keys() - new_data.keys()
+        deleted = old_hashes.keys() - new_hashes.keys()
         # These are the keys that already existed in the databag
         # but had their values changed.
         changed = {
-            key for key in old_data.keys() & new_data.keys() if old_data[key] != new_data[key]
+            key
+            for key in old_hashes.keys() & new_hashes.keys()
+            if old_hashes[key] != new_hashes[key]
         }
 
-        # TODO: update when evaluation of the possibility of losing the diff is completed
-        # happens in the charm before the diff is completely checked (DPE-412).
-        # Convert the new_data to a serializable format and save it for a next diff check.
-        event.relation.data[self.charm.model.app].update({"data": json.dumps(new_data)})
-
         # Return the diff with all possible changes.
         return Diff(added, changed, deleted)
 
+    def _user_keys_changed(self, event: RelationEvent) -> bool:
+        """Returns whether the event could have changed the database or roles of the user."""
+        if type(event) is not RelationChangedEvent:
+            return True
+
+        diff = self._diff(event)
+        return bool((diff.added | diff.changed | diff.deleted) & USER_KEYS)
+
+    def _save_diff(self, event: RelationChangedEvent) -> None:
+        """Saves the hashes of the relation changed databag for the next diff check.
+
+        Hashes are kept in the state of the leader unit rather than in relation
+        data, so saving them triggers no relation-changed event on peers or
+        clients. A new leader has no hashes and reconciles the next change.
+        """
+        relation_data = event.relation.data[self.charm.model.app]
+        if "data" in relation_data:
+            # Drop the copy of the client databag saved by older revisions.
+            relation_data.pop("data")
+
+        username = self._get_username_from_relation_id(event.relation.id)
+        if f"{username}-databag" in self.charm.app_peer_data:
+            # Drop the hashes saved in the peer relation by older revisions.
+            self.charm.app_peer_data.pop(f"{username}-databag")
+        self._relation_state.databag_hashes[username] = self._hash_databag(
+            event.relation.data[event.app]
+        )
+
+    def _get_databag_hashes(self, relation: Relation) -> Dict[str, str]:
+        """Returns the saved hashes of the remote application databag of the relation."""
+        username = self._get_username_from_relation_id(relation.id)
+        if username in self._relation_state.databag_hashes:
+            return dict(self._relation_state.databag_hashes[username])
+
+        # Older revisions saved the hashes in the peer relation, or the whole
+        # client databag in the relation.
+        if f"{username}-databag" in self.charm.app_peer_data:
+            return json.loads(self.charm.app_peer_data[f"{username}-databag"])
+        legacy_data = json.loads(relation.data[self.charm.model.app].get("data", "{}"))
+        return self._hash_databag(legacy_data)
+
+    def _drop_databag_hashes(self, username: str) -> None:
+        """Forget the saved hashes of the databag of a departed relation."""
+        self._relation_state.databag_hashes.pop(username, None)
+        self.charm.app_peer_data.pop(f"{username}-databag", None)
+
+    @staticmethod
+    def _hash_databag(data) -> Dict[str, str]:
+        """Returns the sha256 hash of every value of the databag."""
+        return {
+            key: hashlib.sha256(value.encode()).hexdigest()
+            for key, value in data.items()
+            if key != "data"
+        }
+
     def _get_config(self, username: str, password: Optional[str]) -> MongoDBConfiguration:
         """Construct the config object for future user creation."""
         relation = self._get_relation_from_username(username)
@@ -210,14 +804,77 @@ class MongoDBProvider(Object):
         if relation is None:
             return None
 
+        self._update_relation_data(
+            relation,
+            {
+                "username": config.username,
+                "password": config.password,
+                "database": config.database,
+                "endpoints": ",".join(sorted(config.hosts)),
+                "replset": config.replset,
+                "uris": config.uri,
+                X509_CSR_SUBJECT_KEY: self._get_x509_csr_subject(relation),
+                **self._get_srv_uri(config, self.charm.mongodb_config.tls_external),
+            },
+        )
+
+    def update_app_relation_data(self) -> None:
+        """Refresh the endpoints and URIs of all client relations.
+
+        Run after replica set members change, so that clients do not keep
+        seeding from removed members or miss new ones. Unchanged relations
+        are not written, so clients do not get spurious relation-changed events.
+        """
+        if not self.charm.unit.is_leader():
+            return
+
+        mongodb_config = self.charm.mongodb_config
+        hosts = mongodb_config.hosts
+        for relation in self.model.relations[REL_NAME]:
+            data = relation.data[self.charm.app]
+            if "username" not in data or "password" not in data:
+                # The user of the relation is not created yet.
+                continue
+
+            config = MongoDBConfiguration(
+                replset=self.charm.app.name,
+                database=data.get("database"),
+                username=data["username"],
+                password=data["password"],
+                hosts=hosts,
+                roles=set(),
+                tls_external=False,
+                tls_internal=False,
+            )
+            self._update_relation_data(
+                relation,
+                {
+                    "endpoints": ",".join(sorted(hosts)),
+                    "uris": config.uri,
+                    **self._get_srv_uri(config, mongodb_config.tls_external),
+                },
+            )
+
+    def _get_srv_uri(self, config: MongoDBConfiguration, tls: bool) -> Dict[str, str]:
+        """Return the `srv-uri` relation field, once the charm serves SRV records.
+
+        The URI points to the headless service of the pods of the application,
+        so that clients follow scaling without a new URI. The charm names its
+        port `mongodb` first, from which Kubernetes DNS derives the
+        `_mongodb._tcp` SRV record.
+        """
+        if self.substrate != "k8s" or not self.charm.srv_service_host:
+            return {}
+
+        return {"srv-uri": replace(config, tls_external=tls).srv_uri(self.charm.srv_service_host)}
+
+    def _update_relation_data(self, relation: Relation, values: Dict[str, str]) -> None:
+        """Write only the values that differ from the application relation data."""
         data = relation.data[self.charm.app]
-        data["username"] = config.username
-        data["password"] = config.password
-        data["database"] = config.database
-        data["endpoints"] = ",".join(config.hosts)
-        data["replset"] = config.replset
-        data["uris"] = config.uri
-        relation.data[self.charm.app].update(data)
+        changed = {key: value for key, value in values.items() if data.get(key) != value}
+        if changed:
+            logger.debug("Updating %s in relation %d", sorted(changed), relation.id)
+            data.update(changed)
 
     @staticmethod
     def _get_username_from_relation_id(relation_id: int) -> str:
@@ -264,6 +921,23 @@ class MongoDBProvider(Object):
         logger.debug("Relation ID: %s", relation_id)
         return self.model.get_relation(REL_NAME, relation_id)
 
+    def _get_relation_from_csr(self, csr: str) -> Optional[Relation]:
+        """Return the client relation whose x509 certificate was requested for the CSR."""
+        for relation in self.model.relations[REL_NAME]:
+            username = self._get_username_from_relation_id(relation.id)
+            requested_csr = self.charm.app_peer_data.get(f"{username}-x509-csr")
+            if requested_csr and requested_csr.strip() == csr.strip():
+                return relation
+        return None
+
+    def _get_relation_from_certificate(self, certificate: str) -> Optional[Relation]:
+        """Return the client relation the x509 certificate was shared with."""
+        for relation in self.model.relations[REL_NAME]:
+            shared_certificate = relation.data[self.charm.app].get("x509-certificate")
+            if shared_certificate and shared_certificate.strip() == certificate.strip():
+                return relation
+        return None
+
     @staticmethod
     def _get_database_from_relation(relation: Relation) -> Optional[str]:
         """Return database name from relation."""
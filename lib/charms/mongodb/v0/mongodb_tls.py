@@ -21,7 +21,7 @@ from charms.tls_certificates_interface.v1.tls_certificates import (
     generate_private_key,
 )
 from ops.charm import ActionEvent, RelationBrokenEvent, RelationJoinedEvent
-from ops.framework import Object
+from ops.framework import Object, StoredState
 from ops.model import ActiveStatus, MaintenanceStatus, Unit
 
 # The unique Charmhub library identifier, never change it
@@ -32,19 +32,32 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 3
+LIBPATCH = 9
 
 
 logger = logging.getLogger(__name__)
 TLS_RELATION = "certificates"
+# Values of the key-type config option, as generate_private_key arguments.
+KEY_TYPES = {
+    "rsa-2048": ("rsa", 2048),
+    "rsa-3072": ("rsa", 3072),
+    "rsa-4096": ("rsa", 4096),
+    "ecdsa-p256": ("ecdsa", 256),
+    "ecdsa-p384": ("ecdsa", 384),
+}
+DEFAULT_KEY_TYPE = "rsa-2048"
 
 
 class MongoDBTLS(Object):
     """In this class we manage client database relations."""
 
+    # Private keys generated ahead of time, see _refill_key_pool.
+    _stored = StoredState()
+
     def __init__(self, charm, peer_relation, substrate="k8s"):
         """Manager of MongoDB client relations."""
         super().__init__(charm, "client-relations")
+        self._stored.set_default(key_pool=[], key_pool_type=None)
         self.charm = charm
         self.substrate = substrate
         self.peer_relation = peer_relation
@@ -60,6 +73,7 @@ class MongoDBTLS(Object):
         )
         self.framework.observe(self.certs.on.certificate_available, self._on_certificate_available)
         self.framework.observe(self.certs.on.certificate_expiring, self._on_certificate_expiring)
+        self.framework.observe(self.charm.on.update_status, self._on_update_status)
 
     def _on_set_tls_private_key(self, event: ActionEvent) -> None:
         """Set the TLS private key, which will be used for requesting the certificate."""
@@ -81,7 +95,10 @@ class MongoDBTLS(Object):
     def _request_certificate(self, scope: str, param: Optional[str]):
 
         if param is None:
-            key = generate_private_key()
+            key = self._get_pooled_key()
+            if key is None:
+                key_type, key_size = self._get_key_type()
+                key = generate_private_key(key_type=key_type, key_size=key_size)
         else:
             key = self._parse_tls_file(param)
 
@@ -99,6 +116,78 @@ class MongoDBTLS(Object):
         if self.charm.model.get_relation(TLS_RELATION):
             self.certs.request_certificate_creation(certificate_signing_request=csr)
 
+    def request_client_certificate(self, csr: str, old_csr: Optional[str] = None) -> bool:
+        """Request a certificate for the CSR of a client, replacing the one of old_csr.
+
+        Returns:
+            False if there is no TLS relation to request the certificate from.
+        """
+        if not self.charm.model.get_relation(TLS_RELATION):
+            return False
+
+        if old_csr:
+            self.certs.request_certificate_renewal(
+                old_certificate_signing_request=old_csr.encode("utf-8"),
+                new_certificate_signing_request=csr.encode("utf-8"),
+            )
+        else:
+            self.certs.request_certificate_creation(
+                certificate_signing_request=csr.encode("utf-8")
+            )
+        return True
+
+    def revoke_client_certificate(self, csr: str) -> None:
+        """Revoke the certificate issued for the CSR of a client."""
+        if self.charm.model.get_relation(TLS_RELATION):
+            self.certs.request_certificate_revocation(
+                certificate_signing_request=csr.encode("utf-8")
+            )
+
+    def _get_key_type(self) -> Tuple[str, int]:
+        """Return the type and size of generated private keys from the key-type option."""
+        key_type = self.charm.config.get("key-type", DEFAULT_KEY_TYPE)
+        if key_type not in KEY_TYPES:
+            logger.error("Unknown key-type %s, using %s", key_type, DEFAULT_KEY_TYPE)
+            key_type = DEFAULT_KEY_TYPE
+        return KEY_TYPES[key_type]
+
+    def _get_pooled_key(self) -> Optional[bytes]:
+        """Take a private key of the configured type from the pool, if there is one."""
+        self._discard_stale_key_pool()
+        if not self._stored.key_pool:
+            return None
+        logger.debug("Using a pre-generated private key.")
+        return self._stored.key_pool.pop().encode("utf-8")
+
+    def _discard_stale_key_pool(self) -> None:
+        """Empty the pool if its keys are not of the configured type anymore."""
+        key_type = self.charm.config.get("key-type", DEFAULT_KEY_TYPE)
+        if self._stored.key_pool_type != key_type:
+            self._stored.key_pool = []
+            self._stored.key_pool_type = key_type
+
+    def _on_update_status(self, _) -> None:
+        """Refill the private key pool while the charm is idle."""
+        self._refill_key_pool()
+
+    def _refill_key_pool(self) -> None:
+        """Generate private keys until the pool holds key-pool-size of them.
+
+        Key generation is one of the slowest things the charm does. Keys
+        generated in update-status hooks save that time when a certificate
+        is requested, e.g. when the TLS relation joins.
+        """
+        self._discard_stale_key_pool()
+        size = self.charm.config.get("key-pool-size", 0)
+        if len(self._stored.key_pool) > size:
+            self._stored.key_pool = self._stored.key_pool[:size]
+            return
+
+        key_type, key_size = self._get_key_type()
+        for _ in range(size - len(self._stored.key_pool)):
+            key = generate_private_key(key_type=key_type, key_size=key_size)
+            self._stored.key_pool.append(key.decode("utf-8"))
+
     @staticmethod
     def _parse_tls_file(raw_content: str) -> bytes:
         """Parse TLS files from both plain text or base64 format."""
@@ -161,6 +250,8 @@ class MongoDBTLS(Object):
         ):
             logger.debug("The internal TLS certificate available.")
             scope = "app"  # internal crs
+        elif self.charm.client_relations.set_x509_certificate(event):
+            return
         else:
             logger.error("An unknown certificate available.")
             return
@@ -183,7 +274,7 @@ class MongoDBTLS(Object):
             return
 
         if renewal and self.substrate == "k8s":
-            self.charm.unit.get_container("mongod").stop("mongod")
+            self.charm.stop_mongod_service()
 
         logger.debug("Restarting mongod with TLS enabled.")
         if self.substrate == "vm":
@@ -215,6 +306,8 @@ class MongoDBTLS(Object):
             if not self.charm.unit.is_leader():
                 return
             scope = "app"  # internal cert
+        elif self.charm.client_relations.expire_x509_certificate(event.certificate):
+            return
         else:
             logger.error("An unknown certificate expiring.")
             return
@@ -247,7 +340,7 @@ class MongoDBTLS(Object):
         return [
             f"{self.charm.app.name}-{unit_id}",
             socket.getfqdn(),
-             f"{self.charm.app.name}-{unit_id}.{self.charm.app.name}-endpoints",
+            f"{self.charm.app.name}-{unit_id}.{self.charm.app.name}-endpoints",
             str(self.charm.model.get_binding(self.peer_relation).network.bind_address),
         ]
 
@@ -218,19 +218,23 @@ if __name__ == "__main__":
 """  # noqa: D405, D410, D411, D214, D416
 
 import copy
+import hashlib
 import json
 import logging
+import time
 import uuid
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from cryptography.hazmat.primitives.serialization import pkcs12
-from jsonschema import exceptions, validate  # type: ignore[import]
+from jsonschema import Draft4Validator  # type: ignore[import]
 from ops.charm import CharmBase, CharmEvents, RelationChangedEvent, UpdateStatusEvent
-from ops.framework import EventBase, EventSource, Handle, Object
+from ops.framework import EventBase, EventSource, Handle, Object, StoredState
+from ops.model import Relation
 
 # The unique Charmhub library identifier, never change it
 LIBID = "afd8c2bccf834997afce12c2706d2ede"
@@ -330,6 +334,12 @@ PROVIDER_JSON_SCHEMA = {
 }
 
 
+# Both schemas are Draft 4, their validators are built once per process.
+VALIDATORS = {
+    "provider": Draft4Validator(PROVIDER_JSON_SCHEMA),
+    "requirer": Draft4Validator(REQUIRER_JSON_SCHEMA),
+}
+
 logger = logging.getLogger(__name__)
 
 
@@ -464,6 +474,61 @@ class CertificateRevocationRequestEvent(EventBase):
         self.chain = snapshot["chain"]
 
 
+@lru_cache(maxsize=32)
+def _is_valid(schema: str, serialized_data: str) -> bool:
+    """Validates relation data against the provider or requirer schema.
+
+    Results are memoised by the serialized data, so unchanged databags are
+    validated once per process.
+
+    Args:
+        schema: "provider" or "requirer".
+        serialized_data: relation data in dict format, serialized with sorted keys.
+
+    Returns:
+        bool: Whether relation data is valid.
+    """
+    return VALIDATORS[schema].is_valid(json.loads(serialized_data))
+
+
+def _get_fingerprint(certificate: str) -> str:
+    """Returns the SHA-256 hash of a PEM certificate, without parsing it."""
+    return hashlib.sha256(certificate.strip().encode()).hexdigest()
+
+
+def _index_by_csr(entries: Iterable[Dict]) -> Dict[str, Dict]:
+    """Indexes CSR requests or provided certificates by certificate signing request.
+
+    Args:
+        entries: Dicts with a "certificate_signing_request" key
+
+    Returns:
+        dict: Entries by certificate signing request.
+    """
+    return {entry["certificate_signing_request"]: entry for entry in entries}
+
+
+def _get_relation_data(relation: Relation, entity) -> dict:
+    """Loads the relation data of a unit or application, decoding each content once.
+
+    The decoded data is shared between callers, which must copy it before changing it.
+
+    Args:
+        relation: Juju relation
+        entity: Unit or application whose data is loaded
+
+    Returns:
+        dict: Relation data in dict format.
+    """
+    return _decode_relation_data(relation.id, frozenset(relation.data[entity].items()))
+
+
+@lru_cache(maxsize=32)
+def _decode_relation_data(relation_id: int, raw_relation_data: frozenset) -> dict:
+    """Loads relation data from the items of a relation data bag, memoised by content."""
+    return _load_relation_data(dict(raw_relation_data))
+
+
 def _load_relation_data(raw_relation_data: dict) -> dict:
     """Loads relation data from the relation data bag.
 
@@ -620,25 +685,39 @@ def generate_pfx_package(
     return pfx_bytes
 
 
+# Curves of ECDSA private keys by key size
+EC_CURVES = {256: ec.SECP256R1, 384: ec.SECP384R1}
+
+
 def generate_private_key(
     password: Optional[bytes] = None,
     key_size: int = 2048,
     public_exponent: int = 65537,
+    key_type: str = "rsa",
 ) -> bytes:
     """Generates a private key.
 
     Args:
         password (bytes): Password for decrypting the private key
-        key_size (int): Key size in bytes
-        public_exponent: Public exponent.
+        key_size (int): Key size in bits, 256 or 384 for ECDSA keys
+        public_exponent: Public exponent, for RSA keys only.
+        key_type (str): "rsa" or "ecdsa". ECDSA keys are much faster to generate
+            and make cheaper TLS handshakes.
 
     Returns:
         bytes: Private Key
     """
-    private_key = rsa.generate_private_key(
-        public_exponent=public_exponent,
-        key_size=key_size,
-    )
+    if key_type == "ecdsa":
+        if key_size not in EC_CURVES:
+            raise ValueError(f"Unsupported ECDSA key size: {key_size}")
+        private_key = ec.generate_private_key(EC_CURVES[key_size]())
+    elif key_type == "rsa":
+        private_key = rsa.generate_private_key(
+            public_exponent=public_exponent,
+            key_size=key_size,
+        )
+    else:
+        raise ValueError(f"Unsupported key type: {key_type}")
     key_bytes = private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
         format=serialization.PrivateFormat.TraditionalOpenSSL,
@@ -732,49 +811,6 @@ class TLSCertificatesProvidesV1(Object):
         self.charm = charm
         self.relationship_name = relationship_name
 
-    def _add_certificate(
-        self,
-        relation_id: int,
-        certificate: str,
-        certificate_signing_request: str,
-        ca: str,
-        chain: List[str],
-    ) -> None:
-        """Adds certificate to relation data.
-
-        Args:
-            relation_id (int): Relation id
-            certificate (str): Certificate
-            certificate_signing_request (str): Certificate Signing Request
-            ca (str): CA Certificate
-            chain (list): CA Chain
-
-        Returns:
-            None
-        """
-        relation = self.model.get_relation(
-            relation_name=self.relationship_name, relation_id=relation_id
-        )
-        if not relation:
-            raise RuntimeError(
-                f"Relation {self.relationship_name} does not exist - "
-                f"The certificate request can't be completed"
-            )
-        new_certificate = {
-            "certificate": certificate,
-            "certificate_signing_request": certificate_signing_request,
-            "ca": ca,
-            "chain": chain,
-        }
-        provider_relation_data = _load_relation_data(relation.data[self.charm.app])
-        provider_certificates = provider_relation_data.get("certificates", [])
-        certificates = copy.deepcopy(provider_certificates)
-        if new_certificate in certificates:
-            logger.info("Certificate already in relation data - Doing nothing")
-            return
-        certificates.append(new_certificate)
-        relation.data[self.model.app]["certificates"] = json.dumps(certificates)
-
     def _remove_certificate(
         self,
         relation_id: int,
@@ -799,18 +835,42 @@ class TLSCertificatesProvidesV1(Object):
             raise RuntimeError(
                 f"Relation {self.relationship_name} with relation id {relation_id} does not exist"
             )
-        provider_relation_data = _load_relation_data(relation.data[self.charm.app])
+        self._remove_certificates(
+            relation,
+            certificates={certificate} if certificate else set(),
+            certificate_signing_requests=(
+                {certificate_signing_request} if certificate_signing_request else set()
+            ),
+        )
+
+    def _remove_certificates(
+        self,
+        relation: Relation,
+        certificates: Set[str],
+        certificate_signing_requests: Set[str],
+    ) -> None:
+        """Removes certificates from a relation, writing the relation data once.
+
+        Args:
+            relation (Relation): Juju relation
+            certificates (set): Certificates to remove
+            certificate_signing_requests (set): Certificate signing requests whose
+                certificates to remove
+
+        Returns:
+            None
+        """
+        provider_relation_data = _get_relation_data(relation, self.charm.app)
         provider_certificates = provider_relation_data.get("certificates", [])
-        certificates = copy.deepcopy(provider_certificates)
-        for certificate_dict in certificates:
-            if certificate and certificate_dict["certificate"] == certificate:
-                certificates.remove(certificate_dict)
-            if (
-                certificate_signing_request
-                and certificate_dict["certificate_signing_request"] == certificate_signing_request
-            ):
-                certificates.remove(certificate_dict)
-        relation.data[self.model.app]["certificates"] = json.dumps(certificates)
+        kept_certificates = [
+            certificate_dict
+            for certificate_dict in provider_certificates
+            if certificate_dict["certificate"] not in certificates
+            and certificate_dict["certificate_signing_request"] not in certificate_signing_requests
+        ]
+        if len(kept_certificates) == len(provider_certificates):
+            return
+        relation.data[self.model.app]["certificates"] = json.dumps(kept_certificates)
 
     @staticmethod
     def _relation_data_is_valid(certificates_data: dict) -> bool:
@@ -822,11 +882,7 @@ class TLSCertificatesProvidesV1(Object):
         Returns:
             bool: True/False depending on whether the relation data follows the json schema.
         """
-        try:
-            validate(instance=certificates_data, schema=REQUIRER_JSON_SCHEMA)
-            return True
-        except exceptions.ValidationError:
-            return False
+        return _is_valid("requirer", json.dumps(certificates_data, sort_keys=True))
 
     def set_relation_certificate(
         self,
@@ -845,6 +901,28 @@ class TLSCertificatesProvidesV1(Object):
             chain (list): CA Chain
             relation_id (int): Juju relation ID
 
+        Returns:
+            None
+        """
+        self.set_relation_certificates(
+            certificates=[(certificate_signing_request, certificate, ca, chain)],
+            relation_id=relation_id,
+        )
+
+    def set_relation_certificates(
+        self,
+        certificates: Iterable[Tuple[str, str, str, List[str]]],
+        relation_id: int,
+    ) -> None:
+        """Adds many certificates to relation data in a single write.
+
+        A certificate replaces the one previously issued for the same CSR.
+
+        Args:
+            certificates (iterable): (certificate signing request, certificate, CA
+                certificate, CA chain) tuples
+            relation_id (int): Juju relation ID
+
         Returns:
             None
         """
@@ -853,17 +931,28 @@ class TLSCertificatesProvidesV1(Object):
         )
         if not certificates_relation:
             raise RuntimeError(f"Relation {self.relationship_name} does not exist")
-        self._remove_certificate(
-            certificate_signing_request=certificate_signing_request.strip(),
-            relation_id=relation_id,
-        )
-        self._add_certificate(
-            relation_id=relation_id,
-            certificate=certificate.strip(),
-            certificate_signing_request=certificate_signing_request.strip(),
-            ca=ca.strip(),
-            chain=[cert.strip() for cert in chain],
-        )
+        provider_relation_data = _get_relation_data(certificates_relation, self.charm.app)
+        provider_certificates = _index_by_csr(provider_relation_data.get("certificates", []))
+        changed = False
+        for certificate_signing_request, certificate, ca, chain in certificates:
+            new_certificate = {
+                "certificate": certificate.strip(),
+                "certificate_signing_request": certificate_signing_request.strip(),
+                "ca": ca.strip(),
+                "chain": [cert.strip() for cert in chain],
+            }
+            csr = new_certificate["certificate_signing_request"]
+            if provider_certificates.get(csr) == new_certificate:
+                logger.info("Certificate already in relation data - Doing nothing")
+                continue
+            # Replaced certificates move to the end of the list.
+            provider_certificates.pop(csr, None)
+            provider_certificates[csr] = new_certificate
+            changed = True
+        if changed:
+            certificates_relation.data[self.model.app]["certificates"] = json.dumps(
+                list(provider_certificates.values())
+            )
 
     def remove_certificate(self, certificate: str) -> None:
         """Removes a given certificate from relation data.
@@ -895,23 +984,17 @@ class TLSCertificatesProvidesV1(Object):
         Returns:
             None
         """
-        requirer_relation_data = _load_relation_data(event.relation.data[event.unit])
-        provider_relation_data = _load_relation_data(event.relation.data[self.charm.app])
+        requirer_relation_data = _get_relation_data(event.relation, event.unit)
+        provider_relation_data = _get_relation_data(event.relation, self.charm.app)
         if not self._relation_data_is_valid(requirer_relation_data):
             logger.warning(
                 f"Relation data did not pass JSON Schema validation: {requirer_relation_data}"
             )
             return
-        provider_certificates = provider_relation_data.get("certificates", [])
-        requirer_csrs = requirer_relation_data.get("certificate_signing_requests", [])
-        provider_csrs = [
-            certificate_creation_request["certificate_signing_request"]
-            for certificate_creation_request in provider_certificates
-        ]
-        requirer_unit_csrs = [
-            certificate_creation_request["certificate_signing_request"]
-            for certificate_creation_request in requirer_csrs
-        ]
+        provider_csrs = _index_by_csr(provider_relation_data.get("certificates", []))
+        requirer_unit_csrs = _index_by_csr(
+            requirer_relation_data.get("certificate_signing_requests", [])
+        )
         for certificate_signing_request in requirer_unit_csrs:
             if certificate_signing_request not in provider_csrs:
                 self.on.certificate_creation_request.emit(
@@ -937,28 +1020,35 @@ class TLSCertificatesProvidesV1(Object):
         )
         if not certificates_relation:
             raise RuntimeError(f"Relation {self.relationship_name} does not exist")
-        provider_relation_data = _load_relation_data(certificates_relation.data[self.charm.app])
-        list_of_csrs: List[str] = []
+        provider_relation_data = _get_relation_data(certificates_relation, self.charm.app)
+        csrs: Set[str] = set()
         for unit in certificates_relation.units:
-            requirer_relation_data = _load_relation_data(certificates_relation.data[unit])
-            requirer_csrs = requirer_relation_data.get("certificate_signing_requests", [])
-            list_of_csrs.extend(csr["certificate_signing_request"] for csr in requirer_csrs)
-        provider_certificates = provider_relation_data.get("certificates", [])
-        for certificate in provider_certificates:
-            if certificate["certificate_signing_request"] not in list_of_csrs:
+            requirer_relation_data = _get_relation_data(certificates_relation, unit)
+            csrs.update(
+                _index_by_csr(requirer_relation_data.get("certificate_signing_requests", []))
+            )
+        revoked_certificates = set()
+        for certificate in provider_relation_data.get("certificates", []):
+            if certificate["certificate_signing_request"] not in csrs:
                 self.on.certificate_revocation_request.emit(
                     certificate=certificate["certificate"],
                     certificate_signing_request=certificate["certificate_signing_request"],
                     ca=certificate["ca"],
                     chain=certificate["chain"],
                 )
-                self.remove_certificate(certificate=certificate["certificate"])
+                revoked_certificates.add(certificate["certificate"])
+        self._remove_certificates(
+            certificates_relation,
+            certificates=revoked_certificates,
+            certificate_signing_requests=set(),
+        )
 
 
 class TLSCertificatesRequiresV1(Object):
     """TLS certificates requirer class to be instantiated by TLS certificates requirers."""
 
     on = CertificatesRequirerCharmEvents()
+    _stored = StoredState()
 
     def __init__(
         self,
@@ -978,6 +1068,9 @@ class TLSCertificatesRequiresV1(Object):
         self.relationship_name = relationship_name
         self.charm = charm
         self.expiry_notification_time = expiry_notification_time
+        # Expiry timestamps of provider certificates by fingerprint, the hash of the
+        # provider databag they were parsed from and when they need checking again.
+        self._stored.set_default(databag_hash="", expiries={}, next_check=None)
         self.framework.observe(
             charm.on[relationship_name].relation_changed, self._on_relation_changed
         )
@@ -989,7 +1082,7 @@ class TLSCertificatesRequiresV1(Object):
         relation = self.model.get_relation(self.relationship_name)
         if not relation:
             raise RuntimeError(f"Relation {self.relationship_name} does not exist")
-        requirer_relation_data = _load_relation_data(relation.data[self.model.unit])
+        requirer_relation_data = _get_relation_data(relation, self.model.unit)
         return requirer_relation_data.get("certificate_signing_requests", [])
 
     @property
@@ -1000,7 +1093,7 @@ class TLSCertificatesRequiresV1(Object):
             raise RuntimeError(f"Relation {self.relationship_name} does not exist")
         if not relation.app:
             raise RuntimeError(f"Remote app for relation {self.relationship_name} does not exist")
-        provider_relation_data = _load_relation_data(relation.data[relation.app])
+        provider_relation_data = _get_relation_data(relation, relation.app)
         return provider_relation_data.get("certificates", [])
 
     def _add_requirer_csr(self, csr: str) -> None:
@@ -1120,11 +1213,7 @@ class TLSCertificatesRequiresV1(Object):
         Returns:
             bool: Whether relation data is valid.
         """
-        try:
-            validate(instance=certificates_data, schema=PROVIDER_JSON_SCHEMA)
-            return True
-        except exceptions.ValidationError:
-            return False
+        return _is_valid("provider", json.dumps(certificates_data, sort_keys=True))
 
     def _on_relation_changed(self, event: RelationChangedEvent) -> None:
         """Handler triggerred on relation changed events.
@@ -1142,17 +1231,14 @@ class TLSCertificatesRequiresV1(Object):
         if not relation.app:
             logger.warning(f"No remote app in relation: {self.relationship_name}")
             return
-        provider_relation_data = _load_relation_data(relation.data[relation.app])
+        provider_relation_data = _get_relation_data(relation, relation.app)
         if not self._relation_data_is_valid(provider_relation_data):
             logger.warning(
                 f"Provider relation data did not pass JSON Schema validation: "
                 f"{event.relation.data[event.app]}"
             )
             return
-        requirer_csrs = [
-            certificate_creation_request["certificate_signing_request"]
-            for certificate_creation_request in self._requirer_csrs
-        ]
+        requirer_csrs = _index_by_csr(self._requirer_csrs)
         for certificate in self._provider_certificates:
             if certificate["certificate_signing_request"] in requirer_csrs:
                 self.on.certificate_available.emit(
@@ -1169,6 +1255,9 @@ class TLSCertificatesRequiresV1(Object):
         If they are close to expire (<7 days), emits a CertificateExpiringEvent event and if
         they are expired, emits a CertificateExpiredEvent.
 
+        Certificates are parsed only when the provider databag changed, and nothing is
+        checked until the nearest expiry notification is due.
+
         Args:
             event (UpdateStatusEvent): Juju event
 
@@ -1182,28 +1271,74 @@ class TLSCertificatesRequiresV1(Object):
         if not relation.app:
             logger.warning(f"No remote app in relation: {self.relationship_name}")
             return
-        provider_relation_data = _load_relation_data(relation.data[relation.app])
-        if not self._relation_data_is_valid(provider_relation_data):
-            logger.warning(
-                f"Provider relation data did not pass JSON Schema validation: "
-                f"{relation.data[relation.app]}"
-            )
+        raw_relation_data = relation.data[relation.app]
+        databag_hash = hashlib.sha256(
+            json.dumps(dict(raw_relation_data), sort_keys=True).encode()
+        ).hexdigest()
+        now = time.time()
+        if databag_hash == self._stored.databag_hash and (
+            self._stored.next_check is None or now < self._stored.next_check
+        ):
             return
-        for certificate_dict in self._provider_certificates:
+
+        provider_relation_data = _get_relation_data(relation, relation.app)
+        if databag_hash != self._stored.databag_hash:
+            if not self._relation_data_is_valid(provider_relation_data):
+                logger.warning(
+                    f"Provider relation data did not pass JSON Schema validation: "
+                    f"{raw_relation_data}"
+                )
+                return
+            self._stored.expiries = self._get_expiries(
+                provider_relation_data.get("certificates", [])
+            )
+            self._stored.databag_hash = databag_hash
+
+        notification_time = self.expiry_notification_time * 60 * 60
+        next_check = None
+        for certificate_dict in provider_relation_data.get("certificates", []):
             certificate = certificate_dict["certificate"]
-            try:
-                certificate_object = x509.load_pem_x509_certificate(data=certificate.encode())
-            except ValueError:
-                logger.warning("Could not load certificate.")
+            expiry = self._stored.expiries.get(_get_fingerprint(certificate))
+            if expiry is None:
                 continue
-            time_difference = certificate_object.not_valid_after - datetime.utcnow()
-            if time_difference.total_seconds() < 0:
+            time_difference = expiry - now
+            if time_difference < 0:
                 logger.warning("Certificate is expired")
                 self.on.certificate_expired.emit(certificate=certificate)
                 self.request_certificate_revocation(certificate.encode())
-                continue
-            if time_difference.total_seconds() < (self.expiry_notification_time * 60 * 60):
+            elif time_difference < notification_time:
                 logger.warning("Certificate almost expired")
                 self.on.certificate_expiring.emit(
-                    certificate=certificate, expiry=certificate_object.not_valid_after.isoformat()
+                    certificate=certificate,
+                    expiry=datetime.utcfromtimestamp(expiry).isoformat(),
+                )
+            else:
+                notification = expiry - notification_time
+                next_check = notification if next_check is None else min(next_check, notification)
+                continue
+            # Expiring and expired certificates are reported on every update status.
+            next_check = now
+        self._stored.next_check = next_check
+
+    def _get_expiries(self, certificates: List[Dict[str, str]]) -> Dict[str, float]:
+        """Returns expiry timestamps of certificates by fingerprint.
+
+        Certificates parsed before are not parsed again.
+        """
+        expiries = {}
+        for certificate_dict in certificates:
+            fingerprint = _get_fingerprint(certificate_dict["certificate"])
+            if fingerprint in self._stored.expiries:
+                expiries[fingerprint] = self._stored.expiries[fingerprint]
+                continue
+            try:
+                certificate_object = x509.load_pem_x509_certificate(
+                    data=certificate_dict["certificate"].encode()
                 )
+            except ValueError:
+                logger.warning("Could not load certificate.")
+                continue
+            expiries[fingerprint] = certificate_object.not_valid_after.replace(
+                tzinfo=timezone.utc
+            ).timestamp()
+        return expiries
@@ -10,18 +10,28 @@ simple, secure and highly available setup with automatic recovery on fail-over.
 includes scaling and other capabilities.
 """
 
+import base64
 import logging
+import re
+from dataclasses import replace
 from typing import Dict, Optional
 
+import yaml
 from charms.mongodb.v0.helpers import (
+    DEFAULT_TLS_MODE,
     KEY_FILE,
+    MIN_SCRAM_ITERATION_COUNT,
+    MONGOD_SOCKET,
+    TLS_DISABLED_PROTOCOLS,
     TLS_EXT_CA_FILE,
     TLS_EXT_PEM_FILE,
     TLS_INT_CA_FILE,
     TLS_INT_PEM_FILE,
+    TLS_MODES,
     generate_keyfile,
     generate_password,
     get_create_user_cmd,
+    get_mongod_check_cmd,
     get_mongod_cmd,
 )
 from charms.mongodb.v0.mongodb import (
@@ -34,13 +44,32 @@ from charms.mongodb.v0.mongodb_provider import MongoDBProvider
 from charms.mongodb.v0.mongodb_tls import MongoDBTLS
 from ops.charm import ActionEvent, CharmBase
 from ops.main import main
-from ops.model import ActiveStatus, Container
-from ops.pebble import ExecError, Layer, PathError, ProtocolError
+from ops.model import ActiveStatus, Container, WaitingStatus
+from ops.pebble import CheckStatus, ExecError, PathError, ProtocolError
 from pymongo.errors import PyMongoError
 from tenacity import before_log, retry, stop_after_attempt, wait_fixed
 
+from diagnostics import MongoDBDiagnostics
+from k8s_service import add_srv_port, get_cluster_domain
+from profiling import list_profiles, profile_hook, read_profile, set_profiling_threshold
+from tracing import enable_tracing, span, trace_handlers, traced
+
 logger = logging.getLogger(__name__)
 PEER = "database-peers"
+# cProfile captures of slow hooks are kept here, in the charm container.
+PROFILES_DIR = "/var/lib/juju/hook-profiles"
+# Units waiting for a mongod restart set this key in their peer data. The leader grants
+# RESTART_LOCK_KEY in the app peer data to one of them at a time.
+RESTART_KEY = "restart"
+RESTART_LOCK_KEY = "restart-lock"
+# The SCRAM iteration count is the only mongod argument which can change without a restart.
+SCRAM_ARG_PATTERN = r" --setParameter scramSHA256IterationCount=\d+"
+# Prefix of the unit status set while Pebble health checks of mongod fail.
+CHECKS_FAILING_STATUS = "mongod health checks failing"
+MONGODB_PORT = 27017
+# Fully qualified name of the service serving the SRV records of the members, set once the
+# service has a port named after mongodb.
+SRV_SERVICE_KEY = "srv-service"
 
 
 class MongoDBCharm(CharmBase):
@@ -49,16 +78,35 @@ class MongoDBCharm(CharmBase):
     def __init__(self, *args):
         super().__init__(*args)
 
+        if self.config["tracing-endpoint"]:
+            enable_tracing(
+                self.config["tracing-endpoint"],
+                service_name=self.app.name,
+                attributes={"juju.unit": self.unit.name, "juju.model": self.model.name},
+            )
+
         self.framework.observe(self.on.mongod_pebble_ready, self.on_mongod_pebble_ready)
         self.framework.observe(self.on.start, self._on_start)
+        self.framework.observe(self.on.config_changed, self._on_config_changed)
+        self.framework.observe(self.on.update_status, self._on_update_status)
         self.framework.observe(self.on.leader_elected, self._reconfigure)
+        self.framework.observe(self.on.leader_elected, self._expose_srv_records)
+        self.framework.observe(self.on.update_status, self._expose_srv_records)
         self.framework.observe(self.on[PEER].relation_changed, self._reconfigure)
+        self.framework.observe(self.on[PEER].relation_changed, self._on_rolling_restart)
         self.framework.observe(self.on[PEER].relation_departed, self._reconfigure)
+        # the lock of a departed unit is granted to the next one
+        self.framework.observe(self.on[PEER].relation_departed, self._on_rolling_restart)
+        self.framework.observe(self.on.update_status, self._on_rolling_restart)
         self.framework.observe(self.on.get_password_action, self._on_get_password)
         self.framework.observe(self.on.set_password_action, self._on_set_password)
+        self.framework.observe(self.on.get_hook_profiles_action, self._on_get_hook_profiles)
 
         self.client_relations = MongoDBProvider(self)
         self.tls = MongoDBTLS(self, PEER)
+        self.diagnostics = MongoDBDiagnostics(self)
+        for manager in (self.client_relations, self.tls, self.diagnostics):
+            trace_handlers(type(manager))
 
     def _generate_passwords(self) -> None:
         """Generate passwords and put them into peer relation.
@@ -73,6 +121,7 @@ class MongoDBCharm(CharmBase):
         if not self.get_secret("app", "keyfile"):
             self.set_secret("app", "keyfile", generate_keyfile())
 
+    @traced
     def on_mongod_pebble_ready(self, event) -> None:
         """Configure MongoDB pebble layer specification."""
         # Get a reference the container attribute
@@ -97,20 +146,28 @@ class MongoDBCharm(CharmBase):
         # In the second case, we should restart mongod
         # service only if arguments changed.
         services = container.get_services("mongod")
+        restart_needed = False
         if services and services["mongod"].is_running():
-            new_command = get_mongod_cmd(self.mongodb_config)
+            new_command = self._mongod_cmd
             cur_command = container.get_plan().services["mongod"].command
             if new_command != cur_command:
                 logger.debug("restart MongoDB due to arguments change: %s", new_command)
-                container.stop("mongod")
+                restart_needed = True
 
-        # Add initial Pebble config layer using the Pebble API
-        container.add_layer("mongod", self._mongod_layer, combine=True)
+        if restart_needed:
+            # the layer is added before stopping, so the new kill-delay applies
+            self.stop_mongod_service()
+        else:
+            # Add initial Pebble config layer using the Pebble API
+            with span("pebble.add_layer", {"layer": "mongod"}):
+                container.add_layer("mongod", self._mongod_layer, combine=True)
         # Restart changed services and start startup-enabled services.
-        container.replan()
+        with span("pebble.replan"):
+            container.replan()
         # TODO: rework status
         self.unit.status = ActiveStatus()
 
+    @traced
     def _on_start(self, event) -> None:
         """Initialize MongoDB.
 
@@ -137,7 +194,7 @@ class MongoDBCharm(CharmBase):
             event.defer()
             return
 
-        if not container.exists("/tmp/mongodb-27017.sock"):
+        if not container.exists(MONGOD_SOCKET):
             logger.debug("mongod socket is not ready yet.")
             event.defer()
             return
@@ -174,6 +231,163 @@ class MongoDBCharm(CharmBase):
 
             self.app_peer_data["db_initialised"] = "True"
 
+    @traced
+    def _on_config_changed(self, event) -> None:
+        """Apply charm options, restarting mongod only for those which need it."""
+        set_profiling_threshold(PROFILES_DIR, self.config["profile-hooks"])
+        if self.config["scram-iteration-count"] < MIN_SCRAM_ITERATION_COUNT:
+            logger.warning("scram-iteration-count raised to %d", MIN_SCRAM_ITERATION_COUNT)
+        if self._restart_needed():
+            self._request_restart(event)
+            return
+        if self.unit_peer_data.get(RESTART_KEY):
+            # A restart is in progress, e.g. this event was deferred until
+            # mongod was ready again, which releases the lock.
+            self._grant_restart_lock()
+            self._restart_if_locked(event)
+            return
+        self._apply_runtime_options(event)
+
+    def _apply_runtime_options(self, event) -> None:
+        """Apply options to the running mongod without restarting it.
+
+        The SCRAM iteration count is set at runtime, and the layer is added
+        again, so Pebble gets the new command line and kill-delay without
+        restarting mongod. If mongod is not running, it gets both from the
+        layer added when it starts.
+        """
+        container = self.unit.get_container("mongod")
+        if not container.can_connect():
+            return
+        services = container.get_services("mongod")
+        if not services or not services["mongod"].is_running():
+            return
+
+        if container.get_plan().services["mongod"].command != self._mongod_cmd:
+            try:
+                with MongoDBConnection(self._local_mongodb_config, direct=True) as mongo:
+                    mongo.set_scram_iteration_count(self.scram_iteration_count)
+            except PyMongoError as e:
+                logger.error("Deferring config_changed since: error=%r", e)
+                event.defer()
+                return
+
+        # ops.pebble.Plan drops kill-delay, so the layer cannot be compared
+        # with the plan; adding an unchanged layer does not restart mongod.
+        with span("pebble.add_layer", {"layer": "mongod"}):
+            container.add_layer("mongod", self._mongod_layer, combine=True)
+
+    @traced
+    def _on_update_status(self, _) -> None:
+        """Report failing Pebble health checks of mongod in the unit status.
+
+        Only active and waiting statuses are replaced, so the reason a unit is
+        blocked, e.g. by its client relations, stays visible.
+        """
+        container = self.unit.get_container("mongod")
+        if not container.can_connect():
+            return
+
+        failing = sorted(
+            name
+            for name, check in container.get_checks().items()
+            if check.status != CheckStatus.UP
+        )
+        status = self.unit.status
+        # blocked and maintenance statuses set by other handlers take precedence
+        if failing and isinstance(status, (ActiveStatus, WaitingStatus)):
+            self.unit.status = WaitingStatus(f"{CHECKS_FAILING_STATUS}: {', '.join(failing)}")
+        elif (
+            not failing
+            and isinstance(status, WaitingStatus)
+            and status.message.startswith(CHECKS_FAILING_STATUS)
+        ):
+            self.unit.status = ActiveStatus()
+
+    def _restart_needed(self) -> bool:
+        """Whether the running mongod has arguments which can only change with a restart."""
+        container = self.unit.get_container("mongod")
+        if not container.can_connect():
+            return False
+        services = container.get_services("mongod")
+        if not services or not services["mongod"].is_running():
+            return False
+        cur_command = container.get_plan().services["mongod"].command
+        return re.sub(SCRAM_ARG_PATTERN, "", cur_command) != re.sub(
+            SCRAM_ARG_PATTERN, "", self._mongod_cmd
+        )
+
+    def _request_restart(self, event) -> None:
+        """Ask for the restart lock, so members of the replica set restart one at a time."""
+        self.unit_peer_data[RESTART_KEY] = "requested"
+        self._grant_restart_lock()
+        self._restart_if_locked(event)
+
+    @traced
+    def _on_rolling_restart(self, event) -> None:
+        """Hand the restart lock over and restart mongod if this unit holds it."""
+        self._grant_restart_lock()
+        self._restart_if_locked(event)
+
+    def _grant_restart_lock(self) -> None:
+        """Give the restart lock to the next unit waiting for a restart.
+
+        NB: only leader should execute this function.
+        """
+        if not self.unit.is_leader():
+            return
+        relation = self.model.get_relation(PEER)
+        if relation is None:
+            return
+
+        holder = self.app_peer_data.get(RESTART_LOCK_KEY)
+        waiting = sorted(
+            unit.name
+            for unit in [self.unit, *relation.units]
+            if relation.data[unit].get(RESTART_KEY)
+        )
+        if holder in waiting:
+            return
+        if waiting:
+            logger.info("Granting the restart lock to %s", waiting[0])
+            self.app_peer_data[RESTART_LOCK_KEY] = waiting[0]
+        elif holder:
+            del self.app_peer_data[RESTART_LOCK_KEY]
+
+    def _restart_if_locked(self, event) -> None:
+        """Restart mongod with new arguments once this unit holds the restart lock.
+
+        The lock is released only when mongod is ready again, so the next
+        member restarts only after this one came back.
+        """
+        state = self.unit_peer_data.get(RESTART_KEY)
+        if not state or self.app_peer_data.get(RESTART_LOCK_KEY) != self.unit.name:
+            return
+
+        container = self.unit.get_container("mongod")
+        if not container.can_connect():
+            event.defer()
+            return
+
+        if state == "requested":
+            logger.info("Restarting mongod to apply new arguments")
+            with span("pebble.add_layer", {"layer": "mongod"}):
+                container.add_layer("mongod", self._mongod_layer, combine=True)
+            self._step_down_if_primary()
+            with span("pebble.restart", {"service": "mongod"}):
+                container.restart("mongod")
+            self.unit_peer_data[RESTART_KEY] = "restarted"
+
+        with MongoDBConnection(self._local_mongodb_config, direct=True) as mongo:
+            if not mongo.is_ready:
+                logger.debug("Deferring restart lock release: mongod is not ready yet.")
+                event.defer()
+                return
+
+        del self.unit_peer_data[RESTART_KEY]
+        self._grant_restart_lock()
+
+    @traced
     def _reconfigure(self, event) -> None:
         """Reconfigure replicat set.
 
@@ -214,6 +428,9 @@ class MongoDBCharm(CharmBase):
                             event.defer()
                             return
                     mongo.add_replset_member(member)
+
+                # clients should seed from the current members only
+                self.client_relations.update_app_relation_data()
             except NotReadyError:
                 logger.info("Deferring reconfigure: another member doing sync right now")
                 event.defer()
@@ -221,9 +438,66 @@ class MongoDBCharm(CharmBase):
                 logger.info("Deferring reconfigure: error=%r", e)
                 event.defer()
 
+    @traced
+    def _expose_srv_records(self, _) -> None:
+        """Name the mongod port of the headless service of the pods, so clients get an srv-uri.
+
+        The leader patches the service once; update-status retries, e.g. after
+        the application was trusted. Client relations get the srv-uri then.
+        """
+        if not self.unit.is_leader() or SRV_SERVICE_KEY in self.app_peer_data:
+            return
+
+        domain = get_cluster_domain()
+        if domain is None:
+            logger.warning("Not publishing srv-uri: the cluster domain is unknown")
+            return
+        service = f"{self.app.name}-endpoints"
+        if not add_srv_port(service, self.model.name, MONGODB_PORT):
+            return
+
+        self.app_peer_data[SRV_SERVICE_KEY] = f"{service}.{self.model.name}.svc.{domain}"
+        self.client_relations.update_app_relation_data()
+
+    def stop_mongod_service(self) -> None:
+        """Stop mongod cleanly, handing the primary role over first.
+
+        mongod shuts down cleanly on SIGTERM. The kill-delay of the service
+        gives it time to finish the checkpoint before Pebble sends SIGKILL, so
+        the next start does not replay the journal. The layer is added first,
+        so Pebble stops mongod with the configured kill-delay.
+        """
+        container = self.unit.get_container("mongod")
+        services = container.get_services("mongod")
+        if not services or not services["mongod"].is_running():
+            return
+
+        with span("pebble.add_layer", {"layer": "mongod"}):
+            container.add_layer("mongod", self._mongod_layer, combine=True)
+        self._step_down_if_primary()
+        with span("pebble.stop", {"service": "mongod"}):
+            container.stop("mongod")
+
+    def _step_down_if_primary(self) -> None:
+        """Step down the mongod of this unit if it is the primary, so a secondary takes over."""
+        if "db_initialised" not in self.app_peer_data:
+            return
+
+        try:
+            with MongoDBConnection(self._local_mongodb_config, direct=True) as mongo:
+                if mongo.primary() != self.get_hostname_by_unit(self.unit.name):
+                    return
+                logger.info("Stepping down before stopping mongod")
+                mongo.step_down()
+        except PyMongoError as e:
+            logger.warning("Cannot step down before stopping mongod: %r", e)
+
     @property
-    def _mongod_layer(self) -> Layer:
-        """Returns a Pebble configuration layer for mongod."""
+    def _mongod_layer(self) -> str:
+        """Returns a Pebble configuration layer for mongod.
+
+        The layer is passed to Pebble as YAML, as ops.pebble.Layer drops kill-delay.
+        """
         layer_config = {
             "summary": "mongod layer",
             "description": "Pebble config layer for replicated mongod",
@@ -231,14 +505,38 @@ class MongoDBCharm(CharmBase):
                 "mongod": {
                     "override": "replace",
                     "summary": "mongod",
-                    "command": get_mongod_cmd(self.mongodb_config),
+                    "command": self._mongod_cmd,
                     "startup": "enabled",
                     "user": "mongodb",
                     "group": "mongodb",
+                    "kill-delay": f"{self.config['kill-delay']}s",
+                    # a hung mongod is restarted, like one which exited
+                    "on-check-failure": {"mongod-alive": "restart"},
                 }
             },
+            "checks": {
+                "mongod-alive": {
+                    "override": "replace",
+                    "level": "alive",
+                    "period": "10s",
+                    "timeout": "5s",
+                    "threshold": 3,
+                    "exec": {
+                        "command": get_mongod_check_cmd(
+                            self._get_mongo_shell(self.unit.get_container("mongod"))
+                        )
+                    },
+                },
+                "mongod-ready": {
+                    "override": "replace",
+                    "level": "ready",
+                    "period": "10s",
+                    "threshold": 3,
+                    "tcp": {"port": MONGODB_PORT},
+                },
+            },
         }
-        return Layer(layer_config)
+        return yaml.safe_dump(layer_config)
 
     @property
     def app_peer_data(self) -> Dict:
@@ -249,6 +547,11 @@ class MongoDBCharm(CharmBase):
 
         return relation.data[self.app]
 
+    @property
+    def srv_service_host(self) -> Optional[str]:
+        """Fully qualified name of the service serving the SRV records of the members, if any."""
+        return self.app_peer_data.get(SRV_SERVICE_KEY)
+
     @property
     def unit_peer_data(self) -> Dict:
         """Peer relation data object."""
@@ -282,6 +585,43 @@ class MongoDBCharm(CharmBase):
         else:
             raise RuntimeError("Unknown secret scope.")
 
+    @property
+    def scram_iteration_count(self) -> int:
+        """SCRAM-SHA-256 iteration count from the config, within the bounds of MongoDB.
+
+        Counts below the bound are reported when the config changes.
+        """
+        return max(self.config["scram-iteration-count"], MIN_SCRAM_ITERATION_COUNT)
+
+    @property
+    def tls_mode(self) -> str:
+        """The --tlsMode of client connections, preferTLS if the option is invalid."""
+        mode = self.config["tls-mode"]
+        if mode not in TLS_MODES:
+            logger.error("Unsupported tls-mode %s, using %s", mode, DEFAULT_TLS_MODE)
+            return DEFAULT_TLS_MODE
+        return mode
+
+    @property
+    def tls_min_protocol(self) -> str:
+        """The oldest TLS version accepted by mongod, empty for the mongod default."""
+        protocol = self.config["tls-min-protocol"]
+        if protocol and protocol not in TLS_DISABLED_PROTOCOLS:
+            logger.error("Unsupported tls-min-protocol %s, ignoring it", protocol)
+            return ""
+        return protocol
+
+    @property
+    def _mongod_cmd(self) -> str:
+        """The mongod command line for the current configuration."""
+        return get_mongod_cmd(
+            self.mongodb_config,
+            self.scram_iteration_count,
+            tls_mode=self.tls_mode,
+            tls_min_protocol=self.tls_min_protocol,
+            tls_ciphers=self.config["tls-ciphers"],
+        )
+
     @property
     def mongodb_config(self) -> MongoDBConfiguration:
         """Create a configuration object with settings.
@@ -309,57 +649,40 @@ class MongoDBCharm(CharmBase):
             tls_internal=internal_ca is not None,
         )
 
+    @property
+    def _local_mongodb_config(self) -> MongoDBConfiguration:
+        """Configuration for a direct connection to the mongod of this unit."""
+        return replace(self.mongodb_config, hosts={self.get_hostname_by_unit(self.unit.name)})
+
     def _push_keyfile_to_workload(self, container: Container) -> None:
         """Upload the keyFile to a workload container."""
-        container.push(
-            KEY_FILE,
-            self.get_secret("app", "keyfile"),
-            make_dirs=True,
-            permissions=0o400,
-            user="mongodb",
-            group="mongodb",
-        )
+        self._push_file(container, KEY_FILE, self.get_secret("app", "keyfile"))
 
     def _push_certificate_to_workload(self, container: Container) -> None:
         """Uploads certificate to the workload container."""
         external_ca, external_pem = self.tls.get_tls_files("unit")
         if external_ca is not None:
             logger.debug("Uploading external ca to workload container")
-            container.push(
-                TLS_EXT_CA_FILE,
-                external_ca,
-                make_dirs=True,
-                permissions=0o400,
-                user="mongodb",
-                group="mongodb",
-            )
+            self._push_file(container, TLS_EXT_CA_FILE, external_ca)
         if external_pem is not None:
             logger.debug("Uploading external pem to workload container")
-            container.push(
-                TLS_EXT_PEM_FILE,
-                external_pem,
-                make_dirs=True,
-                permissions=0o400,
-                user="mongodb",
-                group="mongodb",
-            )
+            self._push_file(container, TLS_EXT_PEM_FILE, external_pem)
 
         internal_ca, internal_pem = self.tls.get_tls_files("app")
         if internal_ca is not None:
             logger.debug("Uploading internal ca to workload container")
-            container.push(
-                TLS_INT_CA_FILE,
-                internal_ca,
-                make_dirs=True,
-                permissions=0o400,
-                user="mongodb",
-                group="mongodb",
-            )
+            self._push_file(container, TLS_INT_CA_FILE, internal_ca)
         if internal_pem is not None:
             logger.debug("Uploading internal pem to workload container")
+            self._push_file(container, TLS_INT_PEM_FILE, internal_pem)
+
+    @staticmethod
+    def _push_file(container: Container, path: str, content: str) -> None:
+        """Upload a file readable only by mongod to the workload container."""
+        with span("pebble.push", {"path": path}):
             container.push(
-                TLS_INT_PEM_FILE,
-                internal_pem,
+                path,
+                content,
                 make_dirs=True,
                 permissions=0o400,
                 user="mongodb",
@@ -398,19 +721,24 @@ class MongoDBCharm(CharmBase):
         if "user_created" in self.app_peer_data:
             return
 
-        mongo_cmd = (
-            "/usr/bin/mongosh" if container.exists("/usr/bin/mongosh") else "/usr/bin/mongo"
-        )
+        mongo_cmd = self._get_mongo_shell(container)
 
-        process = container.exec(
-            command=get_create_user_cmd(self.mongodb_config, mongo_cmd),
-            stdin=self.mongodb_config.password,
-        )
-        stdout, _ = process.wait_output()
+        with span("pebble.exec", {"command": mongo_cmd}):
+            process = container.exec(
+                command=get_create_user_cmd(self.mongodb_config, mongo_cmd),
+                stdin=self.mongodb_config.password,
+            )
+            stdout, _ = process.wait_output()
         logger.debug("User created: %s", stdout)
 
         self.app_peer_data["user_created"] = "True"
 
+    @staticmethod
+    def _get_mongo_shell(container: Container) -> str:
+        """Return the path of the MongoDB shell installed in the workload container."""
+        return "/usr/bin/mongosh" if container.exists("/usr/bin/mongosh") else "/usr/bin/mongo"
+
+    @traced
     def _on_get_password(self, event: ActionEvent) -> None:
         """Returns the password for the user as an action response."""
         username = "operator"
@@ -423,6 +751,7 @@ class MongoDBCharm(CharmBase):
             return
         event.set_results({f"{username}-password": self.get_secret("app", f"{username}_password")})
 
+    @traced
     def _on_set_password(self, event: ActionEvent) -> None:
         """Set the password for the specified user."""
         # only leader can write the new password into peer relation.
@@ -462,6 +791,26 @@ class MongoDBCharm(CharmBase):
         self.set_secret("app", f"{username}_password", new_password)
         event.set_results({f"{username}-password": new_password})
 
+    @traced
+    def _on_get_hook_profiles(self, event: ActionEvent) -> None:
+        """List recent hook profiles or return one of them as base64."""
+        if "name" in event.params:
+            try:
+                content = read_profile(PROFILES_DIR, event.params["name"])
+            except (OSError, ValueError) as e:
+                event.fail(f"Cannot read the profile: {e}")
+                return
+            event.set_results(
+                {"name": event.params["name"], "profile": base64.b64encode(content).decode()}
+            )
+            return
+
+        profiles = list_profiles(PROFILES_DIR)[: event.params["count"]]
+        if not profiles:
+            event.log("No hook profiles recorded, check the profile-hooks option.")
+        event.set_results({"profiles": {str(i): profile for i, profile in enumerate(profiles)}})
+
 
 if __name__ == "__main__":
-    main(MongoDBCharm)
+    with profile_hook(PROFILES_DIR):
+        main(MongoDBCharm)
@@ -0,0 +1,657 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""In this class we manage diagnostic actions.
+
+The actions query the MongoDB members with the operator credentials and
+return condensed reports, so that incidents can be investigated without
+an external monitoring stack or a shell inside the workload container.
+"""
+import logging
+import re
+from collections import defaultdict
+from dataclasses import replace
+from typing import Dict, List, Optional, Tuple
+
+from charms.mongodb.v0.mongodb import (
+    CHARM_USERS,
+    MongoDBConfiguration,
+    MongoDBConnection,
+    NotReadyError,
+)
+from ops.charm import ActionEvent
+from ops.framework import Object, StoredState
+from pymongo.errors import PyMongoError
+from tenacity import RetryError, Retrying, stop_after_delay, wait_fixed
+
+logger = logging.getLogger(__name__)
+
+# Number of serverStatus snapshots kept in the unit state to compute rates.
+MAX_SNAPSHOTS = 10
+
+# Relation databases are looked up in the client relations.
+REL_NAME = "database"
+
+# A compacted member has to be a secondary lagging at most this number of
+# seconds behind the primary before the next member is compacted.
+MAX_CATCH_UP_LAG = 10
+CATCH_UP_TIMEOUT = 600
+
+OPCOUNTERS = ("insert", "query", "update", "delete", "getmore", "command")
+# Users of replication, elections and other work between members.
+INTERNAL_USERS = ["__system"]
+# Databases of replication and sharding metadata, e.g. the oplog read by secondaries.
+INTERNAL_DATABASES = ("local", "config")
+# Cumulative WiredTiger cache counters, reported together with their rates.
+EVICTION_COUNTERS = {
+    "pages evicted by application threads": "application-evictions",
+    "modified pages evicted": "modified-evictions",
+    "unmodified pages evicted": "unmodified-evictions",
+}
+
+
+class MongoDBDiagnostics(Object):
+    """In this class we manage diagnostic actions."""
+
+    _stored = StoredState()
+
+    def __init__(self, charm):
+        """Manager of MongoDB diagnostic actions."""
+        super().__init__(charm, "diagnostics")
+        self.charm = charm
+        self._stored.set_default(snapshots=[])
+        self.framework.observe(
+            self.charm.on.get_performance_snapshot_action, self._on_get_performance_snapshot
+        )
+        self.framework.observe(self.charm.on.current_ops_action, self._on_current_ops)
+        self.framework.observe(self.charm.on.kill_ops_action, self._on_kill_ops)
+        self.framework.observe(self.charm.on.get_index_report_action, self._on_get_index_report)
+        self.framework.observe(
+            self.charm.on.get_storage_report_action, self._on_get_storage_report
+        )
+        self.framework.observe(self.charm.on.compact_action, self._on_compact)
+
+    def _on_get_performance_snapshot(self, event: ActionEvent) -> None:
+        """Return a condensed serverStatus report of the local member."""
+        try:
+            with MongoDBConnection(self.charm._local_mongodb_config, direct=True) as mongo:
+                server_status = mongo.get_server_status()
+        except PyMongoError as e:
+            event.fail(f"Failed getting server status: {e}")
+            return
+
+        previous = self._stored.snapshots[-1] if self._stored.snapshots else None
+        report, snapshot = build_performance_report(server_status, previous)
+        self._stored.snapshots = (list(self._stored.snapshots) + [snapshot])[-MAX_SNAPSHOTS:]
+        event.set_results(report)
+
+    def _on_current_ops(self, event: ActionEvent) -> None:
+        """List client operations on the primary matching the action filters."""
+        try:
+            with MongoDBConnection(self.charm.mongodb_config) as mongo:
+                ops = mongo.get_current_ops(current_ops_query(event.params))
+        except PyMongoError as e:
+            event.fail(f"Failed listing operations: {e}")
+            return
+
+        ops = [op for op in ops if not _is_current_op_command(op)]
+        event.set_results(
+            {
+                "count": len(ops),
+                "operations": {str(i): summarise_op(op) for i, op in enumerate(ops)},
+            }
+        )
+
+    def _on_kill_ops(self, event: ActionEvent) -> None:
+        """Kill client operations on the primary matching the action filters.
+
+        Operations of the charm users are never killed, as those are needed for
+        the correct work of the charm. Neither are operations of internal users
+        or without any user, nor those on internal databases, which include the
+        replication traffic between members.
+        """
+        query = current_ops_query(event.params)
+        query["effectiveUsers.0"] = {"$exists": True}
+        query["effectiveUsers.user"] = {
+            "$nin": CHARM_USERS + INTERNAL_USERS,
+            **query.get("effectiveUsers.user", {}),
+        }
+        query["$nor"] = [{"ns": {"$regex": f"^({'|'.join(INTERNAL_DATABASES)})\\."}}]
+        dry_run = event.params.get("dry-run", True)
+        killed, failed = [], []
+        try:
+            with MongoDBConnection(self.charm.mongodb_config) as mongo:
+                ops = [
+                    op
+                    for op in mongo.get_current_ops(query)
+                    if _is_killable(op) and not _is_current_op_command(op)
+                ]
+                if not dry_run:
+                    for op in ops:
+                        try:
+                            mongo.kill_op(op["opid"])
+                            killed.append(op["opid"])
+                        except PyMongoError as e:
+                            # the operation might have finished in the meantime
+                            logger.warning("Failed killing operation %s: %r", op["opid"], e)
+                            failed.append(op["opid"])
+        except PyMongoError as e:
+            event.fail(f"Failed killing operations: {e}")
+            return
+
+        results = {
+            "dry-run": dry_run,
+            "count": len(ops),
+            "operations": {str(i): summarise_op(op) for i, op in enumerate(ops)},
+        }
+        if not dry_run:
+            logger.info("Killed operations: %s", killed)
+            results["killed"] = len(killed)
+            results["failed"] = len(failed)
+        event.set_results(results)
+
+    def _on_get_index_report(self, event: ActionEvent) -> None:
+        """Report unused, duplicate-prefix and oversized indexes of all databases.
+
+        Index access counts are collected from every member, as reads can be
+        served by secondaries, and are reset when a member restarts.
+        """
+        collection_stats = {}
+        index_stats = defaultdict(list)
+        try:
+            with MongoDBConnection(self.charm.mongodb_config) as mongo:
+                for database in mongo.get_databases():
+                    for collection in mongo.get_collections(database):
+                        collection_stats[(database, collection)] = mongo.get_collection_stats(
+                            database, collection
+                        )
+
+            for host in sorted(self.charm.mongodb_config.hosts):
+                with MongoDBConnection(self._member_config(host), direct=True) as mongo:
+                    for database, collection in collection_stats:
+                        index_stats[(database, collection)] += mongo.get_index_stats(
+                            database, collection
+                        )
+        except PyMongoError as e:
+            event.fail(f"Failed collecting index statistics: {e}")
+            return
+
+        report = build_index_report(
+            collection_stats, index_stats, event.params.get("oversized-ratio", 1.0)
+        )
+        relations = self._relations_by_database()
+        databases = {}
+        for i, database in enumerate(sorted(report)):
+            databases[str(i)] = {"name": database}
+            if database in relations:
+                databases[str(i)]["relation-id"] = relations[database]
+            for key, value in report[database].items():
+                databases[str(i)][key] = ", ".join(value) if isinstance(value, list) else value
+
+        event.set_results(
+            {
+                "members": len(self.charm.mongodb_config.hosts),
+                "databases": databases,
+                "summary": {
+                    key: sum(report[database][key] for database in report)
+                    for key in ("flagged-indexes", "flagged-index-bytes", "extra-index-writes")
+                },
+            }
+        )
+
+    def _on_get_storage_report(self, event: ActionEvent) -> None:
+        """Report the storage footprint of all collections on the local member."""
+        collection_stats = {}
+        try:
+            with MongoDBConnection(self.charm._local_mongodb_config, direct=True) as mongo:
+                for database in mongo.get_databases():
+                    for collection in mongo.get_collections(database):
+                        collection_stats[(database, collection)] = mongo.get_collection_stats(
+                            database, collection
+                        )
+        except PyMongoError as e:
+            event.fail(f"Failed collecting storage statistics: {e}")
+            return
+
+        report = build_storage_report(collection_stats)
+        relations = self._relations_by_database()
+        databases = {}
+        for i, database in enumerate(sorted(report)):
+            databases[str(i)] = {"name": database, **report[database]}
+            if database in relations:
+                databases[str(i)]["relation-id"] = relations[database]
+
+        event.set_results(
+            {
+                "databases": databases,
+                "summary": {
+                    key: sum(report[database][key] for database in report)
+                    for key in ("size", "storage-size", "index-size", "reusable-bytes")
+                },
+            }
+        )
+
+    def _on_compact(self, event: ActionEvent) -> None:
+        """Compact all collections member by member, the primary last.
+
+        Each secondary is compacted in turn and has to catch up with the primary
+        before the next one. Then the primary steps down and is compacted as a
+        secondary, so that compaction never competes with the writes.
+        """
+        if not self.charm.unit.is_leader():
+            event.fail("The action can be run only on the leader unit.")
+            return
+
+        try:
+            with MongoDBConnection(self.charm.mongodb_config) as mongo:
+                primary = mongo.primary()
+                collections = {
+                    database: mongo.get_collections(database)
+                    for database in mongo.get_databases()
+                    if event.params.get("database") in (None, database)
+                }
+            secondaries = sorted(self.charm.mongodb_config.hosts - {primary})
+            if primary is None or not secondaries:
+                event.fail("Compaction needs a primary and at least one secondary.")
+                return
+
+            freed = {}
+            for host in secondaries:
+                freed[host] = self._compact_member(host, collections)
+
+            logger.info("Stepping down %s to compact it", primary)
+            with MongoDBConnection(self.charm.mongodb_config) as mongo:
+                mongo.step_down()
+            self._wait_for_catch_up(primary)
+            freed[primary] = self._compact_member(primary, collections)
+        except RetryError:
+            event.fail("A member did not catch up with the primary after compaction.")
+            return
+        except PyMongoError as e:
+            event.fail(f"Failed compacting collections: {e}")
+            return
+
+        event.set_results(
+            {
+                "members": {
+                    str(i): {"host": host, "bytes-freed": bytes_freed}
+                    for i, (host, bytes_freed) in enumerate(freed.items())
+                },
+                "bytes-freed": sum(freed.values()),
+            }
+        )
+
+    def _compact_member(self, host: str, collections: Dict[str, List[str]]) -> int:
+        """Compact collections on a secondary and wait until it catches up.
+
+        Returns:
+            Bytes freed, as reported by MongoDB 4.4 and later.
+
+        Raises:
+            PyMongoError, RetryError
+        """
+        logger.info("Compacting collections on %s", host)
+        bytes_freed = 0
+        with MongoDBConnection(self._member_config(host), direct=True) as mongo:
+            for database, database_collections in collections.items():
+                for collection in database_collections:
+                    result = mongo.compact(database, collection)
+                    bytes_freed += int(result.get("bytesFreed", 0))
+
+        self._wait_for_catch_up(host)
+        return bytes_freed
+
+    def _wait_for_catch_up(self, host: str) -> None:
+        """Wait until the member is a secondary close behind the primary.
+
+        Raises:
+            RetryError if the member did not catch up in CATCH_UP_TIMEOUT seconds.
+        """
+        for attempt in Retrying(stop=stop_after_delay(CATCH_UP_TIMEOUT), wait=wait_fixed(5)):
+            with attempt:
+                with MongoDBConnection(self.charm.mongodb_config) as mongo:
+                    states = mongo.get_replset_status()
+                    lag = mongo.get_replication_lag()
+                caught_up = lag.get(host, CATCH_UP_TIMEOUT) <= MAX_CATCH_UP_LAG
+                if states.get(host) != "SECONDARY" or not caught_up:
+                    raise NotReadyError
+
+    def _relations_by_database(self) -> Dict[str, int]:
+        """Return relation ids by the database requested in the relation."""
+        return {
+            relation.data[relation.app].get("database"): relation.id
+            for relation in self.model.relations[REL_NAME]
+        }
+
+    def _member_config(self, host: str) -> MongoDBConfiguration:
+        """Configuration for a direct connection to a single replica set member."""
+        return replace(self.charm.mongodb_config, hosts={host})
+
+
+def current_ops_query(params: Dict) -> Dict:
+    """Build the $match expression selecting operations from the action params.
+
+    Args:
+        params: action params - seconds-running, namespace (database or
+            database.collection), user (e.g. relation-5) and op-type.
+    """
+    query = {
+        "active": True,
+        # operations of internal threads (e.g. replication) have no client
+        "client": {"$exists": True},
+        "secs_running": {"$gte": params.get("seconds-running", 0)},
+    }
+
+    namespace = params.get("namespace")
+    if namespace and "." in namespace:
+        query["ns"] = namespace
+    elif namespace:
+        query["ns"] = {"$regex": f"^{re.escape(namespace)}\\."}
+
+    if params.get("user"):
+        query["effectiveUsers.user"] = {"$eq": params["user"]}
+
+    if params.get("op-type"):
+        query["op"] = params["op-type"]
+
+    return query
+
+
+def summarise_op(op: Dict) -> Dict:
+    """Return the fields of a $currentOp entry needed to decide whether to kill it.
+
+    Command documents are not returned as they can contain application data.
+    """
+    command = op.get("command", {})
+    return {
+        "opid": str(op["opid"]),
+        "op": op.get("op", ""),
+        "ns": op.get("ns", ""),
+        "command": next(iter(command), ""),
+        "secs-running": op.get("secs_running", 0),
+        "users": ",".join(user["user"] for user in op.get("effectiveUsers", [])),
+        "client": op.get("client", ""),
+        "app-name": op.get("appName", ""),
+        "plan-summary": op.get("planSummary", ""),
+        "waiting-for-lock": op.get("waitingForLock", False),
+    }
+
+
+def _is_killable(op: Dict) -> bool:
+    """Whether the operation was started by a client user on a client database.
+
+    The $currentOp match already leaves the others out; this guards against
+    killing them if it ever did not.
+    """
+    users = [user.get("user") for user in op.get("effectiveUsers") or []]
+    if not users or set(users) & set(CHARM_USERS + INTERNAL_USERS):
+        return False
+    return op.get("ns", "").split(".", 1)[0] not in INTERNAL_DATABASES
+
+
+def _is_current_op_command(op: Dict) -> bool:
+    """Whether the operation is the $currentOp aggregation listing operations."""
+    pipeline: List[Dict] = op.get("command", {}).get("pipeline", [])
+    return bool(pipeline) and "$currentOp" in pipeline[0]
+
+
+def build_index_report(
+    collection_stats: Dict[Tuple[str, str], Dict],
+    index_stats: Dict[Tuple[str, str], List[Dict]],
+    oversized_ratio: float,
+) -> Dict[str, Dict]:
+    """Find indexes that add write cost without serving reads.
+
+    Args:
+        collection_stats: $collStats output by (database, collection).
+        index_stats: $indexStats output of all members by (database, collection).
+        oversized_ratio: indexes larger than the collection data times this
+            ratio are reported as oversized, unless the collection holds no
+            data.
+
+    Returns:
+        A report by database listing `collection.index` names of unused,
+        duplicate-prefix and oversized indexes, the size of the flagged
+        indexes and the writes they added since the statistics were reset.
+        The _id index is never flagged.
+    """
+    report = {}
+    for (database, collection), stats in sorted(collection_stats.items()):
+        database_report = report.setdefault(
+            database,
+            {
+                "indexes": 0,
+                "unused": [],
+                "duplicate-prefix": [],
+                "oversized": [],
+                "flagged-indexes": 0,
+                "flagged-index-bytes": 0,
+                "extra-index-writes": 0,
+            },
+        )
+        storage = stats.get("storageStats", {})
+        index_sizes = storage.get("indexSizes", {})
+        data_size = storage.get("size", 0)
+        writes = stats.get("latencyStats", {}).get("writes", {}).get("ops", 0)
+
+        # merge access counts of the same index on all members
+        indexes = {}
+        for index in index_stats.get((database, collection), []):
+            merged = indexes.setdefault(index["name"], {**index, "ops": 0})
+            merged["ops"] += int(index["accesses"]["ops"])
+        database_report["indexes"] += len(indexes)
+
+        flagged = set()
+        for name, index in indexes.items():
+            if name == "_id_":
+                continue
+            qualified_name = f"{collection}.{name}"
+            if index["ops"] == 0:
+                database_report["unused"].append(qualified_name)
+                flagged.add(name)
+            covering = _covering_index(index, indexes.values())
+            if covering is not None:
+                database_report["duplicate-prefix"].append(
+                    f"{qualified_name} (prefix of {covering})"
+                )
+                flagged.add(name)
+            # the bare index structures outweigh the data of empty collections
+            if data_size and index_sizes.get(name, 0) > data_size * oversized_ratio:
+                database_report["oversized"].append(qualified_name)
+                flagged.add(name)
+
+        database_report["flagged-indexes"] += len(flagged)
+        database_report["flagged-index-bytes"] += sum(index_sizes.get(name, 0) for name in flagged)
+        # every write to the collection also updates each of its indexes
+        database_report["extra-index-writes"] += int(writes) * len(flagged)
+
+    return report
+
+
+def build_storage_report(collection_stats: Dict[Tuple[str, str], Dict]) -> Dict[str, Dict]:
+    """Summarise the storage footprint of collections by database.
+
+    Reusable bytes are the free blocks inside WiredTiger files, that are
+    reused for new data but given back to the file system only by `compact`.
+
+    Args:
+        collection_stats: $collStats output by (database, collection).
+    """
+    report = {}
+    for (database, collection), stats in sorted(collection_stats.items()):
+        storage = stats.get("storageStats", {})
+        reusable = _reusable_bytes(storage.get("wiredTiger", {}))
+        reusable_index = sum(
+            _reusable_bytes(index) for index in storage.get("indexDetails", {}).values()
+        )
+        collection_report = {
+            "name": collection,
+            "size": int(storage.get("size", 0)),
+            "storage-size": int(storage.get("storageSize", 0)),
+            "index-size": int(storage.get("totalIndexSize", 0)),
+            "reusable-bytes": reusable + reusable_index,
+        }
+        storage_size = collection_report["storage-size"] + collection_report["index-size"]
+        collection_report["reusable-ratio"] = (
+            round(collection_report["reusable-bytes"] / storage_size, 4) if storage_size else 0
+        )
+
+        database_report = report.setdefault(
+            database,
+            {
+                "size": 0,
+                "storage-size": 0,
+                "index-size": 0,
+                "reusable-bytes": 0,
+                "collections": {},
+            },
+        )
+        for key in ("size", "storage-size", "index-size", "reusable-bytes"):
+            database_report[key] += collection_report[key]
+        collections = database_report["collections"]
+        collections[str(len(collections))] = collection_report
+
+    return report
+
+
+def _reusable_bytes(wired_tiger_stats: Dict) -> int:
+    """Return the free bytes of a WiredTiger file."""
+    return int(wired_tiger_stats.get("block-manager", {}).get("file bytes available for reuse", 0))
+
+
+def _covering_index(index: Dict, indexes) -> Optional[str]:
+    """Return the name of another index whose key starts with the key of the index.
+
+    Unique, sparse, partial and TTL indexes are never reported as duplicates,
+    as they are not equivalent to the longer index.
+    """
+    spec = index.get("spec", {})
+    if spec.get("unique") or spec.get("sparse"):
+        return None
+    if "partialFilterExpression" in spec or "expireAfterSeconds" in spec:
+        return None
+
+    key = list(index["key"].items())
+    for other in indexes:
+        other_key = list(other["key"].items())
+        if other["name"] != index["name"] and len(other_key) > len(key):
+            if other_key[: len(key)] == key:
+                return other["name"]
+    return None
+
+
+def build_performance_report(server_status: Dict, previous: Optional[Dict]) -> Tuple[Dict, Dict]:
+    """Derive a compact report from a serverStatus document.
+
+    Args:
+        server_status: output of the serverStatus command.
+        previous: snapshot returned by the previous call, used to compute rates.
+            Rates are omitted when there is no previous snapshot or mongod was
+            restarted since then.
+
+    Returns:
+        A tuple of the report, formatted as action results, and the snapshot
+        of cumulative counters to pass to the next call.
+    """
+    cache = server_status.get("wiredTiger", {}).get("cache", {})
+    snapshot = {
+        "uptime-millis": int(server_status["uptimeMillis"]),
+        "opcounters": {op: int(server_status["opcounters"][op]) for op in OPCOUNTERS},
+        "eviction": {key: int(cache.get(stat, 0)) for stat, key in EVICTION_COUNTERS.items()},
+        "page-faults": int(server_status.get("extra_info", {}).get("page_faults", 0)),
+    }
+
+    report = {
+        "uptime": snapshot["uptime-millis"] // 1000,
+        "opcounters": snapshot["opcounters"],
+        "cache": _cache_report(cache),
+        "eviction": snapshot["eviction"],
+        "tickets": _tickets_report(server_status),
+        "connections": _connections_report(server_status.get("connections", {})),
+        "queues": _queues_report(server_status.get("globalLock", {})),
+        "page-faults": snapshot["page-faults"],
+    }
+
+    if previous and previous["uptime-millis"] < snapshot["uptime-millis"]:
+        interval = (snapshot["uptime-millis"] - previous["uptime-millis"]) / 1000
+        report["interval"] = round(interval, 3)
+        report["opcounters-per-second"] = _rates(
+            snapshot["opcounters"], previous["opcounters"], interval
+        )
+        report["eviction-per-second"] = _rates(
+            snapshot["eviction"], previous["eviction"], interval
+        )
+        report["page-faults-per-second"] = round(
+            (snapshot["page-faults"] - previous["page-faults"]) / interval, 3
+        )
+
+    return report, snapshot
+
+
+def _rates(current: Dict[str, int], previous: Dict[str, int], interval: float) -> Dict:
+    """Per second rates of cumulative counters."""
+    return {
+        key: round((value - previous.get(key, 0)) / interval, 3) for key, value in current.items()
+    }
+
+
+def _cache_report(cache: Dict) -> Dict:
+    """Fill and dirty ratios of the WiredTiger cache.
+
+    WiredTiger starts evicting with application threads, which stalls
+    operations, once the cache is 95% full or 20% dirty.
+    """
+    maximum = int(cache.get("maximum bytes configured", 0))
+    used = int(cache.get("bytes currently in the cache", 0))
+    dirty = int(cache.get("tracked dirty bytes in the cache", 0))
+    return {
+        "max-bytes": maximum,
+        "used-bytes": used,
+        "dirty-bytes": dirty,
+        "fill-ratio": round(used / maximum, 4) if maximum else 0,
+        "dirty-ratio": round(dirty / maximum, 4) if maximum else 0,
+    }
+
+
+def _tickets_report(server_status: Dict) -> Dict:
+    """Read and write ticket availability.
+
+    MongoDB 7.0 moved tickets from wiredTiger.concurrentTransactions to
+    queues.execution.
+    """
+    tickets = server_status.get("queues", {}).get("execution")
+    if tickets is None:
+        tickets = server_status.get("wiredTiger", {}).get("concurrentTransactions", {})
+
+    report = {}
+    for kind in ("read", "write"):
+        kind_tickets = tickets.get(kind, {})
+        report[kind] = {
+            "out": int(kind_tickets.get("out", 0)),
+            "available": int(kind_tickets.get("available", 0)),
+            "total": int(kind_tickets.get("totalTickets", 0)),
+        }
+    return report
+
+
+def _connections_report(connections: Dict) -> Dict:
+    """Connection counts."""
+    return {
+        "current": int(connections.get("current", 0)),
+        "available": int(connections.get("available", 0)),
+        "active": int(connections.get("active", 0)),
+        "total-created": int(connections.get("totalCreated", 0)),
+    }
+
+
+def _queues_report(global_lock: Dict) -> Dict:
+    """Operations queued for locks and active clients."""
+    queue = global_lock.get("currentQueue", {})
+    active = global_lock.get("activeClients", {})
+    return {
+        "total": int(queue.get("total", 0)),
+        "readers": int(queue.get("readers", 0)),
+        "writers": int(queue.get("writers", 0)),
+        "active-readers": int(active.get("readers", 0)),
+        "active-writers": int(active.get("writers", 0)),
+    }
@@ -0,0 +1,87 @@
+"""Kubernetes DNS records of the replica set members."""
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import logging
+from typing import Optional
+
+import httpx
+from lightkube import Client
+from lightkube.core.exceptions import ApiError, ConfigError
+from lightkube.resources.core_v1 import Service
+
+logger = logging.getLogger(__name__)
+
+RESOLV_CONF = "/etc/resolv.conf"
+# Kubernetes DNS serves `_<port name>._tcp.<service>` SRV records for named
+# ports, and drivers look up `_mongodb._tcp` for `mongodb+srv` URIs.
+SRV_PORT_NAME = "mongodb"
+
+
+def get_cluster_domain(resolv_conf: str = RESOLV_CONF) -> Optional[str]:
+    """Return the DNS domain of the Kubernetes cluster, or None if it is unknown.
+
+    Pods search `<namespace>.svc.<domain>`, `svc.<domain>` and `<domain>`, so
+    the domain is read from the search list rather than assumed to be
+    `cluster.local`.
+    """
+    try:
+        with open(resolv_conf) as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        logger.warning("Cannot read the cluster domain from %s: %r", resolv_conf, e)
+        return None
+
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0] != "search":
+            continue
+        for domain in fields[1:]:
+            if domain.startswith("svc."):
+                return domain.split(".", 1)[1]
+    return None
+
+
+def add_srv_port(service: str, namespace: str, port: int) -> bool:
+    """Add a port named `mongodb` to a service, so that its SRV record exists.
+
+    The port is merged into the ports of the service, which are left as they
+    are. Patching the service needs the application to be trusted.
+
+    Returns:
+        whether the service has the port.
+    """
+    try:
+        client = Client(namespace=namespace)
+        current = client.get(Service, name=service, namespace=namespace)
+        if any(p.name == SRV_PORT_NAME for p in current.spec.ports or []):
+            return True
+
+        logger.info("Adding port %s to service %s", SRV_PORT_NAME, service)
+        client.patch(
+            Service,
+            name=service,
+            namespace=namespace,
+            obj={
+                "spec": {
+                    "ports": [
+                        {
+                            "name": SRV_PORT_NAME,
+                            "port": port,
+                            "targetPort": port,
+                            "protocol": "TCP",
+                        }
+                    ]
+                }
+            },
+        )
+    except ApiError as e:
+        if e.status.code == 403:
+            logger.error("Cannot patch service %s, is the application trusted?", service)
+        else:
+            logger.error("Cannot patch service %s: %r", service, e)
+        return False
+    except (ConfigError, httpx.HTTPError) as e:
+        logger.error("Cannot connect to the Kubernetes API: %r", e)
+        return False
+    return True
@@ -0,0 +1,122 @@
+"""Opt-in cProfile capture of slow hooks."""
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import cProfile
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Profiles above this count are rotated out, oldest first.
+MAX_PROFILES = 20
+# Holds the duration threshold (in seconds); profiling is disabled when it is missing.
+THRESHOLD_FILE = "threshold"
+PROFILE_SUFFIX = ".pstats"
+
+
+def set_profiling_threshold(directory: str, threshold: float) -> None:
+    """Enable profiling of hooks slower than threshold seconds, or disable it if zero.
+
+    The threshold is kept in a file because it has to be known before the charm
+    (and its config) is loaded, and reading a file is cheaper than a `config-get`.
+    """
+    path = os.path.join(directory, THRESHOLD_FILE)
+    if threshold <= 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        f.write(str(threshold))
+
+
+def _get_profiling_threshold(directory: str) -> Optional[float]:
+    """Return the duration threshold or None if profiling is disabled."""
+    try:
+        with open(os.path.join(directory, THRESHOLD_FILE)) as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def profile_hook(directory: str) -> Iterator[None]:
+    """Run the wrapped block under cProfile if profiling is enabled.
+
+    The profile is saved only if the block ran longer than the configured
+    threshold. File names are `<unix time>-<hook>-<duration in ms>.pstats`.
+    """
+    threshold = _get_profiling_threshold(directory)
+    if threshold is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    start = time.monotonic()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        duration = time.monotonic() - start
+        if duration >= threshold:
+            hook_name = os.path.basename(os.environ.get("JUJU_DISPATCH_PATH", "")) or "dispatch"
+            name = f"{int(time.time())}-{hook_name}-{int(duration * 1000)}{PROFILE_SUFFIX}"
+            try:
+                profiler.dump_stats(os.path.join(directory, name))
+                _rotate_profiles(directory)
+            except OSError as e:
+                logger.warning("Cannot save hook profile %s: %r", name, e)
+
+
+def _rotate_profiles(directory: str) -> None:
+    """Remove the oldest profiles above MAX_PROFILES."""
+    for profile in list_profiles(directory)[MAX_PROFILES:]:
+        os.remove(os.path.join(directory, profile["name"]))
+
+
+def list_profiles(directory: str) -> List[Dict]:
+    """Return saved profiles, most recent first.
+
+    Returns:
+        A list of dicts with the file name, hook name and duration in ms.
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    profiles = []
+    for name in os.listdir(directory):
+        if not name.endswith(PROFILE_SUFFIX):
+            continue
+        timestamp, _, rest = name[: -len(PROFILE_SUFFIX)].partition("-")
+        hook_name, _, duration = rest.rpartition("-")
+        try:
+            profile = {
+                "name": name,
+                "timestamp": int(timestamp),
+                "hook": hook_name,
+                "duration-ms": int(duration),
+            }
+        except ValueError:
+            logger.debug("Ignoring %s, not named like a hook profile", name)
+            continue
+        profiles.append(profile)
+    return sorted(profiles, key=lambda profile: profile["timestamp"], reverse=True)
+
+
+def read_profile(directory: str, name: str) -> bytes:
+    """Return the content of a saved profile.
+
+    Raises:
+        ValueError if there is no profile with the name.
+    """
+    if name not in [profile["name"] for profile in list_profiles(directory)]:
+        raise ValueError(f"No such profile: {name}")
+
+    with open(os.path.join(directory, name), "rb") as f:
+        return f.read()
@@ -0,0 +1,324 @@
+"""Tracing of charm hooks in the OpenTelemetry (OTLP-JSON) format."""
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import atexit
+import functools
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# OTLP enum values, see opentelemetry/proto/trace/v1/trace.proto
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+# OTLP/HTTP collectors accept traces on this path.
+OTLP_HTTP_TRACES_PATH = "/v1/traces"
+OTLP_HTTP_TIMEOUT = 2
+
+
+class Span:
+    """A single finished or in-progress span.
+
+    — name: operation name.
+    — trace_id: 32 hex digits shared by all spans of a hook.
+    — span_id: 16 hex digits.
+    — parent_id: span_id of the parent span, None for the root span.
+    — kind: OTLP span kind.
+    — attributes: flat mapping of span attributes.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        kind: int = SPAN_KIND_INTERNAL,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time_ns()
+        self.end_time: Optional[int] = None
+        self.status_code = STATUS_CODE_OK
+        self.status_message = ""
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        """Mark the span finished, optionally as failed."""
+        self.end_time = time.time_ns()
+        if error is not None:
+            self.status_code = STATUS_CODE_ERROR
+            self.status_message = repr(error)
+
+    def to_otlp(self) -> Dict:
+        """Return the span in the OTLP-JSON encoding."""
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time or time.time_ns()),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": self.status_code},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.status_message:
+            span["status"]["message"] = self.status_message
+        return span
+
+
+class Tracer:
+    """Collects the spans of one hook dispatch and exports them when the hook ends.
+
+    A tracer without an endpoint is disabled: spans are not recorded and the
+    overhead of instrumented code is a single attribute check.
+    """
+
+    def __init__(self):
+        self.endpoint: Optional[str] = None
+        self.resource: Dict[str, Any] = {}
+        self.trace_id = secrets.token_hex(16)
+        self.root: Optional[Span] = None
+        self._finished: List[Span] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether spans are recorded."""
+        return self.endpoint is not None
+
+    def enable(self, endpoint: str, resource: Dict[str, Any], root_name: str) -> None:
+        """Start recording spans under a root span named after the hook.
+
+        Args:
+            endpoint: `file://<path>` to append OTLP-JSON lines to a file, or the
+                http(s) URL of an OTLP/HTTP collector.
+            resource: resource attributes, e.g. service.name.
+            root_name: name of the root span, usually the hook name.
+        """
+        self.endpoint = endpoint
+        self.resource = dict(resource)
+        self.root = Span(root_name, self.trace_id, None)
+
+    def current(self) -> Optional[Span]:
+        """Return the innermost active span of the calling thread."""
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            return stack[-1]
+        return self.root
+
+    def start(
+        self, name: str, kind: int = SPAN_KIND_INTERNAL, attributes: Optional[Dict] = None
+    ) -> Span:
+        """Create a span that is a child of the current span, without activating it."""
+        parent = self.current()
+        return Span(name, self.trace_id, parent.span_id if parent else None, kind, attributes)
+
+    def finish(self, span: Span, error: Optional[BaseException] = None) -> None:
+        """End the span and queue it for export."""
+        span.end(error)
+        with self._lock:
+            self._finished.append(span)
+
+    @contextmanager
+    def span(self, name: str, attributes: Optional[Dict] = None) -> Iterator[Optional[Span]]:
+        """Record the wrapped block as an active span."""
+        if not self.enabled:
+            yield None
+            return
+
+        span = self.start(name, attributes=attributes)
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            self.finish(span, e)
+            raise
+        else:
+            self.finish(span)
+        finally:
+            stack.pop()
+
+    def flush(self) -> None:
+        """Export all finished spans together with the root span."""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            spans, self._finished = self._finished, []
+        if self.root is not None and self.root.end_time is None:
+            self.root.end()
+            spans.append(self.root)
+        if not spans:
+            return
+
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": _otlp_attributes(self.resource)},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        try:
+            self._export(json.dumps(payload))
+        except (OSError, ValueError) as e:
+            # Tracing must never break a hook.
+            logger.warning("Cannot export %d spans to %s: %r", len(spans), self.endpoint, e)
+
+    def _export(self, data: str) -> None:
+        """Write serialised spans to the configured endpoint."""
+        if self.endpoint.startswith("file://"):
+            path = self.endpoint.split("file://", 1)[1]
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a") as f:
+                f.write(data + "\n")
+            return
+
+        url = self.endpoint.rstrip("/")
+        if not url.endswith(OTLP_HTTP_TRACES_PATH):
+            url += OTLP_HTTP_TRACES_PATH
+        request = urllib.request.Request(
+            url,
+            data=data.encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=OTLP_HTTP_TIMEOUT):
+            pass
+
+
+class _CommandListener(monitoring.CommandListener):
+    """Records every MongoDB command sent by pymongo as a client span.
+
+    Only command names and targets are recorded, never command documents, as
+    those can contain credentials.
+    """
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        self._spans: Dict[int, Span] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if not self.tracer.enabled:
+            return
+        host, port = event.connection_id
+        self._spans[event.request_id] = self.tracer.start(
+            f"mongodb.{event.command_name}",
+            kind=SPAN_KIND_CLIENT,
+            attributes={
+                "db.system": "mongodb",
+                "db.name": event.database_name,
+                "db.operation": event.command_name,
+                "net.peer.name": host,
+                "net.peer.port": port,
+            },
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        span = self._spans.pop(event.request_id, None)
+        if span is not None:
+            self.tracer.finish(span)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        span = self._spans.pop(event.request_id, None)
+        if span is not None:
+            span.attributes["db.failure"] = str(event.failure.get("errmsg", ""))
+            self.tracer.finish(span, RuntimeError(event.failure.get("codeName", "failed")))
+
+
+_tracer = Tracer()
+
+
+def enable_tracing(endpoint: str, service_name: str, attributes: Dict[str, Any]) -> None:
+    """Record spans of the current hook and export them when the process exits.
+
+    MongoDB commands are traced by a pymongo listener, which only instruments
+    clients created after this call.
+
+    Args:
+        endpoint: `file://<path>` or the URL of an OTLP/HTTP collector.
+        service_name: value of the service.name resource attribute.
+        attributes: additional resource attributes, e.g. the unit name.
+    """
+    if _tracer.enabled:
+        return
+
+    dispatch_path = os.environ.get("JUJU_DISPATCH_PATH", "")
+    hook_name = os.path.basename(dispatch_path) or "dispatch"
+    _tracer.enable(endpoint, {"service.name": service_name, **attributes}, hook_name)
+    monitoring.register(_CommandListener(_tracer))
+    atexit.register(_tracer.flush)
+
+
+def span(name: str, attributes: Optional[Dict] = None):
+    """Context manager recording the wrapped block as a child of the current span."""
+    return _tracer.span(name, attributes)
+
+
+def traced(handler: Callable) -> Callable:
+    """Decorator recording an event handler as a span."""
+
+    @functools.wraps(handler)
+    def wrapper(self, event, *args, **kwargs):
+        if not _tracer.enabled:
+            return handler(self, event, *args, **kwargs)
+        name = f"{type(self).__name__}.{handler.__name__}"
+        with _tracer.span(name, {"juju.event": type(event).__name__}):
+            return handler(self, event, *args, **kwargs)
+
+    return wrapper
+
+
+def trace_handlers(cls: type) -> None:
+    """Record the event handlers of a charm library class as spans.
+
+    Charm libraries do not depend on this module, so their handlers, named
+    `_on_*` by convention, are wrapped in place. Handlers already wrapped are
+    left as they are.
+    """
+    for name, handler in list(vars(cls).items()):
+        if name.startswith("_on_") and callable(handler) and not hasattr(handler, "__wrapped__"):
+            setattr(cls, name, traced(handler))
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict]:
+    """Encode attributes as a list of OTLP KeyValue objects."""
+    encoded = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            encoded_value = {"boolValue": value}
+        elif isinstance(value, int):
+            # int64 values are encoded as strings in OTLP-JSON.
+            encoded_value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            encoded_value = {"doubleValue": value}
+        else:
+            encoded_value = {"stringValue": str(value)}
+        encoded.append({"key": key, "value": encoded_value})
+    return encoded
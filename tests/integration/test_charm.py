@@ -36,8 +36,13 @@ async def test_build_and_deploy(ops_test: OpsTest):
     # build and deploy charm from local source folder
     charm = await ops_test.build_charm(".")
     resources = {"mongodb-image": METADATA["resources"]["mongodb-image"]["upstream-source"]}
+    # trusted, so that the charm can name the port of the service serving SRV records
     await ops_test.model.deploy(
-        charm, resources=resources, application_name=APP_NAME, num_units=len(UNIT_IDS)
+        charm,
+        resources=resources,
+        application_name=APP_NAME,
+        num_units=len(UNIT_IDS),
+        trust=True,
     )
 
     # issuing dummy update_status just to trigger an event
@@ -5,8 +5,17 @@ import unittest
 from unittest import mock
 from unittest.mock import patch
 
-from ops.model import ActiveStatus, ModelError
-from ops.pebble import APIError, ExecError, PathError, ProtocolError
+import yaml
+from ops.model import ActiveStatus, BlockedStatus, ModelError, WaitingStatus
+from ops.pebble import (
+    APIError,
+    CheckInfo,
+    CheckLevel,
+    CheckStatus,
+    ExecError,
+    PathError,
+    ProtocolError,
+)
 from ops.testing import Harness
 from pymongo.errors import (
     ConfigurationError,
@@ -59,6 +68,7 @@ class TestCharm(unittest.TestCase):
                         "--keyFile=/etc/mongodb/keyFile"
                     ),
                     "startup": "enabled",
+                    "on-check-failure": {"mongod-alive": "restart"},
                 }
             },
         }
@@ -78,6 +88,255 @@ class TestCharm(unittest.TestCase):
         assert self.harness.model.unit.status == ActiveStatus()
         defer.assert_not_called()
 
+    @patch("ops.framework.EventBase.defer")
+    @patch("charm.MongoDBConnection")
+    def test_scram_iteration_count_applied_without_restart(self, connection, defer):
+        """Verifies a new SCRAM iteration count is set at runtime and kept for restarts."""
+        container = self.harness.model.unit.get_container("mongod")
+        self.harness.set_can_connect(container, True)
+        self.harness.charm.on.mongod_pebble_ready.emit(container)
+
+        self.harness.update_config({"scram-iteration-count": 20000})
+
+        mongo = connection.return_value.__enter__.return_value
+        mongo.set_scram_iteration_count.assert_called_once_with(20000)
+        self.assertTrue(connection.call_args[1]["direct"])
+        command = self.harness.get_container_pebble_plan("mongod").services["mongod"].command
+        self.assertIn("--setParameter scramSHA256IterationCount=20000", command)
+        defer.assert_not_called()
+
+        # unchanged counts do not connect to mongod
+        self.harness.update_config({"profile-hooks": 0.0})
+        mongo.set_scram_iteration_count.assert_called_once()
+
+        # failures are retried
+        mongo.set_scram_iteration_count.side_effect = ConnectionFailure("error message")
+        with self.assertLogs("charm", "WARNING") as logs:
+            self.harness.update_config({"scram-iteration-count": 1000})
+        mongo.set_scram_iteration_count.assert_called_with(5000)
+        defer.assert_called_once()
+        # counts below the bound are reported once, not on every read
+        warnings = [r for r in logs.output if "scram-iteration-count raised" in r]
+        self.assertEqual(len(warnings), 1)
+
+    @patch("charm.MongoDBConnection")
+    def test_mongod_stopped_gracefully(self, connection):
+        """Verifies the primary steps down before mongod is stopped with a kill delay."""
+        container = self.harness.model.unit.get_container("mongod")
+        self.harness.set_can_connect(container, True)
+        self.harness.update_config({"kill-delay": 120})
+        layer = yaml.safe_load(self.harness.charm._mongod_layer)
+        self.assertEqual(layer["services"]["mongod"]["kill-delay"], "120s")
+
+        self.harness.charm.on.mongod_pebble_ready.emit(container)
+        self.harness.charm.app_peer_data["db_initialised"] = "True"
+
+        mongo = connection.return_value.__enter__.return_value
+        mongo.primary.return_value = "mongodb-k8s-0.mongodb-k8s-endpoints"
+        self.harness.charm.stop_mongod_service()
+        mongo.step_down.assert_called_once()
+        self.assertFalse(container.get_service("mongod").is_running())
+
+        # secondaries are stopped without a step down, errors do not prevent the stop
+        container.start("mongod")
+        mongo.primary.return_value = "mongodb-k8s-1.mongodb-k8s-endpoints"
+        self.harness.charm.stop_mongod_service()
+        mongo.step_down.assert_called_once()
+        self.assertFalse(container.get_service("mongod").is_running())
+
+        container.start("mongod")
+        mongo.primary.side_effect = ConnectionFailure("error message")
+        self.harness.charm.stop_mongod_service()
+        mongo.step_down.assert_called_once()
+        self.assertFalse(container.get_service("mongod").is_running())
+
+    @patch("ops.framework.EventBase.defer")
+    @patch("charm.MongoDBConnection")
+    def test_kill_delay_applied_without_restart(self, connection, defer):
+        """Verifies a new kill-delay reaches Pebble, also before mongod is stopped."""
+        container = self.harness.model.unit.get_container("mongod")
+        self.harness.set_can_connect(container, True)
+        self.harness.charm.on.mongod_pebble_ready.emit(container)
+
+        with patch("ops.model.Container.add_layer") as add_layer:
+            self.harness.update_config({"kill-delay": 60})
+            layer = yaml.safe_load(add_layer.call_args[0][1])
+            self.assertEqual(layer["services"]["mongod"]["kill-delay"], "60s")
+            self.assertTrue(container.get_service("mongod").is_running())
+            connection.assert_not_called()
+
+            add_layer.reset_mock()
+            self.harness.charm.stop_mongod_service()
+            add_layer.assert_called_once()
+        defer.assert_not_called()
+
+    @patch("charm.add_srv_port")
+    @patch("charm.get_cluster_domain")
+    def test_srv_records_exposed(self, get_cluster_domain, add_srv_port):
+        """Verifies the leader names the port of the headless service once it can."""
+        get_cluster_domain.return_value = "k8s.test"
+        add_srv_port.return_value = False
+        self.harness.charm._expose_srv_records(None)
+        add_srv_port.assert_called_once_with(
+            "mongodb-k8s-endpoints", self.harness.model.name, 27017
+        )
+        self.assertIsNone(self.harness.charm.srv_service_host)
+
+        add_srv_port.return_value = True
+        self.harness.charm._expose_srv_records(None)
+        self.assertEqual(
+            self.harness.charm.srv_service_host,
+            f"mongodb-k8s-endpoints.{self.harness.model.name}.svc.k8s.test",
+        )
+
+        # the service is patched once
+        self.harness.charm._expose_srv_records(None)
+        self.assertEqual(add_srv_port.call_count, 2)
+
+    @patch("ops.model.Container.get_checks")
+    def test_health_checks(self, get_checks):
+        """Verifies the layer has mongod health checks and failing ones are in the unit status."""
+        container = self.harness.model.unit.get_container("mongod")
+        self.harness.set_can_connect(container, True)
+        checks = yaml.safe_load(self.harness.charm._mongod_layer)["checks"]
+        self.assertEqual(checks["mongod-alive"]["level"], "alive")
+        self.assertIn("/tmp/mongodb-27017.sock", checks["mongod-alive"]["exec"]["command"])
+        self.assertEqual(checks["mongod-ready"]["tcp"], {"port": 27017})
+
+        self.harness.charm.on.mongod_pebble_ready.emit(container)
+        get_checks.return_value = {
+            "mongod-alive": CheckInfo("mongod-alive", CheckLevel.ALIVE, CheckStatus.DOWN),
+            "mongod-ready": CheckInfo("mongod-ready", CheckLevel.READY, CheckStatus.UP),
+        }
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            WaitingStatus("mongod health checks failing: mongod-alive"),
+        )
+
+        get_checks.return_value["mongod-alive"].status = CheckStatus.UP
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+        # blocked statuses are kept
+        blocked = BlockedStatus("cannot have both legacy and new relations")
+        self.harness.charm.unit.status = blocked
+        get_checks.return_value["mongod-alive"].status = CheckStatus.DOWN
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.charm.unit.status, blocked)
+
+    @patch("ops.framework.EventBase.defer")
+    @patch("charm.MongoDBConnection")
+    @patch("charms.mongodb.v0.mongodb_tls.MongoDBTLS.get_tls_files")
+    def test_tls_options_applied_with_restart(self, get_tls_files, connection, defer):
+        """Verifies TLS options are added to the command line and applied by a restart."""
+        get_tls_files.return_value = ("ca", "pem")
+        container = self.harness.model.unit.get_container("mongod")
+        self.harness.set_can_connect(container, True)
+        self.harness.charm.on.mongod_pebble_ready.emit(container)
+
+        with patch("ops.model.Container.restart") as restart:
+            self.harness.update_config(
+                {
+                    "tls-mode": "allowTLS",
+                    "tls-min-protocol": "TLS1_3",
+                    "tls-ciphers": "ECDHE+AESGCM:!aNULL",
+                }
+            )
+            restart.assert_called_once_with("mongod")
+
+        command = self.harness.get_container_pebble_plan("mongod").services["mongod"].command
+        self.assertIn("--tlsMode=allowTLS", command)
+        self.assertIn("--tlsDisabledProtocols=TLS1_0,TLS1_1,TLS1_2", command)
+        self.assertIn("--setParameter opensslCipherConfig='ECDHE+AESGCM:!aNULL'", command)
+        # the lock is released once mongod is ready again
+        self.assertNotIn("restart", self.harness.charm.unit_peer_data)
+        self.assertNotIn("restart-lock", self.harness.charm.app_peer_data)
+        defer.assert_not_called()
+
+        # invalid values fall back to the defaults
+        with patch("ops.model.Container.restart") as restart:
+            self.harness.update_config({"tls-mode": "requireTLS", "tls-min-protocol": "SSL3"})
+            restart.assert_called_once_with("mongod")
+        command = self.harness.get_container_pebble_plan("mongod").services["mongod"].command
+        self.assertIn("--tlsMode=preferTLS", command)
+        self.assertNotIn("--tlsDisabledProtocols", command)
+
+    @patch("ops.framework.EventBase.defer")
+    @patch("charm.MongoDBConnection")
+    @patch("charms.mongodb.v0.mongodb_tls.MongoDBTLS.get_tls_files")
+    def test_rolling_restart_one_unit_at_a_time(self, get_tls_files, connection, defer):
+        """Verifies the leader hands the restart lock over once a member is ready again."""
+        get_tls_files.return_value = ("ca", "pem")
+        rel_id = self.harness.charm.model.get_relation("database-peers").id
+        self.harness.add_relation_unit(rel_id, "mongodb-k8s/1")
+        self.harness.update_relation_data(rel_id, "mongodb-k8s/1", {"restart": "requested"})
+        self.assertEqual(self.harness.charm.app_peer_data["restart-lock"], "mongodb-k8s/1")
+
+        # the leader waits for the lock held by its peer
+        container = self.harness.model.unit.get_container("mongod")
+        self.harness.set_can_connect(container, True)
+        self.harness.charm.on.mongod_pebble_ready.emit(container)
+        with patch("ops.model.Container.restart") as restart:
+            self.harness.update_config({"tls-mode": "allowTLS"})
+            restart.assert_not_called()
+        self.assertEqual(self.harness.charm.unit_peer_data["restart"], "requested")
+
+        # the peer restarted and released the lock, the leader restarts but is not ready yet
+        mongo = connection.return_value.__enter__.return_value
+        type(mongo).is_ready = mock.PropertyMock(return_value=False)
+        with patch("ops.model.Container.restart") as restart:
+            self.harness.update_relation_data(rel_id, "mongodb-k8s/1", {"restart": ""})
+            restart.assert_called_once_with("mongod")
+        self.assertEqual(self.harness.charm.app_peer_data["restart-lock"], "mongodb-k8s/0")
+        self.assertEqual(self.harness.charm.unit_peer_data["restart"], "restarted")
+        defer.assert_called()
+
+        # the lock is released once mongod is ready, without restarting again
+        type(mongo).is_ready = mock.PropertyMock(return_value=True)
+        with patch("ops.model.Container.restart") as restart:
+            self.harness.charm._on_rolling_restart(mock.Mock())
+            restart.assert_not_called()
+        self.assertNotIn("restart", self.harness.charm.unit_peer_data)
+        self.assertNotIn("restart-lock", self.harness.charm.app_peer_data)
+
+    @patch("charm.MongoDBConnection")
+    @patch("charms.mongodb.v0.mongodb_tls.MongoDBTLS.get_tls_files")
+    def test_restart_lock_released_by_deferred_event(self, get_tls_files, connection):
+        """Verifies the deferred config-changed event releases the lock once mongod is ready."""
+        get_tls_files.return_value = ("ca", "pem")
+        container = self.harness.model.unit.get_container("mongod")
+        self.harness.set_can_connect(container, True)
+        self.harness.charm.on.mongod_pebble_ready.emit(container)
+
+        mongo = connection.return_value.__enter__.return_value
+        type(mongo).is_ready = mock.PropertyMock(return_value=False)
+        with patch("ops.model.Container.restart") as restart:
+            self.harness.update_config({"tls-mode": "allowTLS"})
+            restart.assert_called_once_with("mongod")
+        self.assertEqual(self.harness.charm.app_peer_data["restart-lock"], "mongodb-k8s/0")
+        self.assertEqual(self.harness.charm.unit_peer_data["restart"], "restarted")
+
+        type(mongo).is_ready = mock.PropertyMock(return_value=True)
+        with patch("ops.model.Container.restart") as restart:
+            self.harness.framework.reemit()
+            restart.assert_not_called()
+        self.assertNotIn("restart", self.harness.charm.unit_peer_data)
+        self.assertNotIn("restart-lock", self.harness.charm.app_peer_data)
+
+    def test_restart_lock_of_departed_unit_granted(self):
+        """Verifies the lock held by a unit which left goes to the next waiting unit."""
+        rel_id = self.harness.charm.model.get_relation("database-peers").id
+        self.harness.add_relation_unit(rel_id, "mongodb-k8s/1")
+        self.harness.add_relation_unit(rel_id, "mongodb-k8s/2")
+        self.harness.update_relation_data(rel_id, "mongodb-k8s/1", {"restart": "restarted"})
+        self.harness.update_relation_data(rel_id, "mongodb-k8s/2", {"restart": "requested"})
+        self.assertEqual(self.harness.charm.app_peer_data["restart-lock"], "mongodb-k8s/1")
+
+        self.harness.remove_relation_unit(rel_id, "mongodb-k8s/1")
+
+        self.assertEqual(self.harness.charm.app_peer_data["restart-lock"], "mongodb-k8s/2")
+
     @patch("ops.framework.EventBase.defer")
     @patch("charm.MongoDBCharm._push_keyfile_to_workload")
     def test_pebble_ready_cannot_retrieve_container(self, push_keyfile_to_workload, defer):
@@ -405,6 +664,33 @@ class TestCharm(unittest.TestCase):
             # verify app data
             self.assertEqual("db_initialised" in self.harness.charm.app_peer_data, False)
 
+    @patch("ops.framework.EventBase.defer")
+    @patch("charm.MongoDBProvider.update_app_relation_data")
+    @patch("charm.MongoDBConnection")
+    def test_reconfigure_updates_client_relations(self, connection, update_relations, defer):
+        """Tests client relations are refreshed only when the replica set members change."""
+        self.harness.set_leader(True)
+        self.harness.charm.app_peer_data["db_initialised"] = "True"
+        rel = self.harness.charm.model.get_relation("database-peers")
+        connection.return_value.__enter__.return_value.get_replset_members.return_value = {
+            "mongodb-k8s-0.mongodb-k8s-endpoints"
+        }
+
+        # simulate 2nd MongoDB unit joining
+        self.harness.add_relation_unit(rel.id, "mongodb-k8s/1")
+        self.harness.update_relation_data(rel.id, "mongodb-k8s/1", PEER_ADDR)
+        connection.return_value.__enter__.return_value.add_replset_member.assert_called()
+        update_relations.assert_called_once()
+
+        # no member change, no refresh
+        connection.return_value.__enter__.return_value.get_replset_members.return_value = {
+            "mongodb-k8s-0.mongodb-k8s-endpoints",
+            "mongodb-k8s-1.mongodb-k8s-endpoints",
+        }
+        self.harness.update_relation_data(rel.id, "mongodb-k8s/1", {"private-address": "1.1.1.2"})
+        update_relations.assert_called_once()
+        defer.assert_not_called()
+
     @patch("ops.framework.EventBase.defer")
     @patch("charm.MongoDBConnection")
     def test_reconfigure_not_already_initialised(self, connection, defer):
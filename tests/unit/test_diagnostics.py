@@ -0,0 +1,449 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+from ops.testing import Harness
+from pymongo.errors import ConnectionFailure, OperationFailure
+from tenacity import RetryError
+
+from charm import MongoDBCharm
+from diagnostics import (
+    build_index_report,
+    build_performance_report,
+    build_storage_report,
+    current_ops_query,
+)
+from tests.unit.helpers import patch_network_get
+
+DIAGNOSTICS_MODULE = "diagnostics"
+
+
+def server_status(uptime_millis, inserts, evictions, page_faults):
+    return {
+        "uptimeMillis": uptime_millis,
+        "opcounters": {
+            "insert": inserts,
+            "query": 10,
+            "update": 0,
+            "delete": 0,
+            "getmore": 0,
+            "command": 100,
+        },
+        "wiredTiger": {
+            "cache": {
+                "maximum bytes configured": 1000,
+                "bytes currently in the cache": 950,
+                "tracked dirty bytes in the cache": 100,
+                "pages evicted by application threads": evictions,
+            },
+            "concurrentTransactions": {
+                "read": {"out": 1, "available": 127, "totalTickets": 128},
+                "write": {"out": 128, "available": 0, "totalTickets": 128},
+            },
+        },
+        "connections": {"current": 5, "available": 95, "active": 2, "totalCreated": 20},
+        "globalLock": {
+            "currentQueue": {"total": 3, "readers": 0, "writers": 3},
+            "activeClients": {"readers": 1, "writers": 128},
+        },
+        "extra_info": {"page_faults": page_faults},
+    }
+
+
+def index_stats(name, key, ops, **spec):
+    return {"name": name, "key": key, "accesses": {"ops": ops}, "spec": {"key": key, **spec}}
+
+
+def client_op(opid, secs_running, ns="my-db.orders", op="query"):
+    return {
+        "opid": opid,
+        "op": op,
+        "ns": ns,
+        "secs_running": secs_running,
+        "effectiveUsers": [{"user": "relation-5", "db": "admin"}],
+    }
+
+
+ORDERS_STATS = {
+    "storageStats": {
+        "size": 1000,
+        "indexSizes": {"_id_": 100, "status_1": 50, "status_1_date_1": 80, "notes_text": 1500},
+    },
+    "latencyStats": {"writes": {"ops": 10}},
+}
+
+
+class TestMongoDBDiagnostics(unittest.TestCase):
+    @patch_network_get(private_address="1.1.1.1")
+    def setUp(self):
+        self.harness = Harness(MongoDBCharm)
+        self.harness.begin()
+        self.harness.add_relation("database-peers", "mongodb-peers")
+        self.charm = self.harness.charm
+        self.addCleanup(self.harness.cleanup)
+
+    def test_report_without_previous_snapshot(self):
+        report, snapshot = build_performance_report(server_status(10000, 50, 4, 7), None)
+
+        self.assertEqual(report["uptime"], 10)
+        self.assertEqual(report["opcounters"]["insert"], 50)
+        self.assertEqual(report["cache"]["fill-ratio"], 0.95)
+        self.assertEqual(report["cache"]["dirty-ratio"], 0.1)
+        self.assertEqual(report["tickets"]["write"], {"out": 128, "available": 0, "total": 128})
+        self.assertEqual(report["queues"]["writers"], 3)
+        self.assertNotIn("opcounters-per-second", report)
+        self.assertEqual(snapshot["uptime-millis"], 10000)
+
+    def test_report_rates(self):
+        """Verifies rates are computed against the previous snapshot unless mongod restarted."""
+        _, previous = build_performance_report(server_status(10000, 50, 4, 7), None)
+
+        report, _ = build_performance_report(server_status(12000, 250, 10, 9), previous)
+        self.assertEqual(report["interval"], 2)
+        self.assertEqual(report["opcounters-per-second"]["insert"], 100)
+        self.assertEqual(report["eviction-per-second"]["application-evictions"], 3)
+        self.assertEqual(report["page-faults-per-second"], 1)
+
+        # counters are reset when mongod restarts
+        report, _ = build_performance_report(server_status(1000, 5, 0, 0), previous)
+        self.assertNotIn("opcounters-per-second", report)
+
+    def test_report_tickets_from_execution_queues(self):
+        """Verifies tickets are read from queues.execution on MongoDB 7.0 and later."""
+        status = server_status(10000, 50, 4, 7)
+        status["queues"] = {
+            "execution": {
+                "read": {"out": 2, "available": 6, "totalTickets": 8},
+                "write": {"out": 0, "available": 8, "totalTickets": 8},
+            }
+        }
+        report, _ = build_performance_report(status, None)
+        self.assertEqual(report["tickets"]["read"], {"out": 2, "available": 6, "total": 8})
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_performance_snapshot_action(self, connection):
+        """Verifies the local member is queried directly and snapshots are kept for rates."""
+        get_server_status = connection.return_value.__enter__.return_value.get_server_status
+        get_server_status.side_effect = [
+            server_status(10000, 50, 4, 7),
+            server_status(12000, 250, 10, 9),
+        ]
+
+        event = mock.Mock()
+        self.charm.diagnostics._on_get_performance_snapshot(event)
+        self.charm.diagnostics._on_get_performance_snapshot(event)
+
+        config = connection.call_args[0][0]
+        self.assertEqual(config.hosts, {self.charm.get_hostname_by_unit(self.charm.unit.name)})
+        self.assertTrue(connection.call_args[1]["direct"])
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["opcounters-per-second"]["insert"], 100)
+        self.assertEqual(len(self.charm.diagnostics._stored.snapshots), 2)
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_performance_snapshot_action_failure(self, connection):
+        connection.return_value.__enter__.return_value.get_server_status.side_effect = (
+            ConnectionFailure("error message")
+        )
+
+        event = mock.Mock()
+        self.charm.diagnostics._on_get_performance_snapshot(event)
+
+        event.fail.assert_called()
+        event.set_results.assert_not_called()
+
+    def test_current_ops_query(self):
+        """Verifies the action params are translated into a $currentOp match."""
+        query = current_ops_query({"seconds-running": 30})
+        self.assertEqual(query["secs_running"], {"$gte": 30})
+        self.assertEqual(query["client"], {"$exists": True})
+        self.assertNotIn("ns", query)
+
+        query = current_ops_query(
+            {"namespace": "my-db", "user": "relation-5", "op-type": "command"}
+        )
+        self.assertEqual(query["ns"], {"$regex": "^my\\-db\\."})
+        self.assertEqual(query["effectiveUsers.user"], {"$eq": "relation-5"})
+        self.assertEqual(query["op"], "command")
+
+        query = current_ops_query({"namespace": "my-db.orders"})
+        self.assertEqual(query["ns"], "my-db.orders")
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_current_ops_action(self, connection):
+        """Verifies operations are summarised and the listing operation is left out."""
+        get_current_ops = connection.return_value.__enter__.return_value.get_current_ops
+        get_current_ops.return_value = [
+            {
+                "opid": 42,
+                "op": "command",
+                "ns": "my-db.orders",
+                "command": {"aggregate": "orders", "pipeline": [{"$group": {}}]},
+                "secs_running": 120,
+                "effectiveUsers": [{"user": "relation-5", "db": "admin"}],
+                "planSummary": "COLLSCAN",
+            },
+            {
+                "opid": 43,
+                "op": "command",
+                "ns": "admin.$cmd.aggregate",
+                "command": {"aggregate": 1, "pipeline": [{"$currentOp": {"allUsers": True}}]},
+                "secs_running": 0,
+            },
+        ]
+
+        event = mock.Mock(params={"seconds-running": 0})
+        self.charm.diagnostics._on_current_ops(event)
+
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["count"], 1)
+        operation = results["operations"]["0"]
+        self.assertEqual(operation["opid"], "42")
+        self.assertEqual(operation["command"], "aggregate")
+        self.assertEqual(operation["users"], "relation-5")
+        self.assertEqual(operation["plan-summary"], "COLLSCAN")
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_kill_ops_dry_run(self, connection):
+        """Verifies nothing is killed by default and charm users are excluded."""
+        mongo = connection.return_value.__enter__.return_value
+        mongo.get_current_ops.return_value = [client_op(42, 120)]
+
+        event = mock.Mock(params={"seconds-running": 60, "user": "relation-5", "dry-run": True})
+        self.charm.diagnostics._on_kill_ops(event)
+
+        query = mongo.get_current_ops.call_args[0][0]
+        self.assertEqual(
+            query["effectiveUsers.user"],
+            {"$nin": ["operator", "__system"], "$eq": "relation-5"},
+        )
+        self.assertEqual(query["effectiveUsers.0"], {"$exists": True})
+        self.assertEqual(query["$nor"], [{"ns": {"$regex": "^(local|config)\\."}}])
+        mongo.kill_op.assert_not_called()
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["count"], 1)
+        self.assertNotIn("killed", results)
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_kill_ops(self, connection):
+        """Verifies a failure killing one operation does not stop killing the others."""
+        mongo = connection.return_value.__enter__.return_value
+        mongo.get_current_ops.return_value = [client_op(42, 120), client_op(43, 90)]
+        mongo.kill_op.side_effect = [OperationFailure("error message"), None]
+
+        event = mock.Mock(params={"seconds-running": 60, "dry-run": False})
+        self.charm.diagnostics._on_kill_ops(event)
+
+        mongo.kill_op.assert_has_calls([mock.call(42), mock.call(43)])
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["killed"], 1)
+        self.assertEqual(results["failed"], 1)
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_kill_ops_internal_operations(self, connection):
+        """Verifies replication and other internal operations are never killed."""
+        mongo = connection.return_value.__enter__.return_value
+        system_op = client_op(1, 120, ns="local.oplog.rs", op="getmore")
+        system_op["effectiveUsers"] = [{"user": "__system", "db": "local"}]
+        charm_op = client_op(2, 120)
+        charm_op["effectiveUsers"] = [{"user": "operator", "db": "admin"}]
+        no_users_op = client_op(3, 120)
+        del no_users_op["effectiveUsers"]
+        empty_users_op = client_op(4, 120)
+        empty_users_op["effectiveUsers"] = []
+        mongo.get_current_ops.return_value = [
+            system_op,
+            charm_op,
+            no_users_op,
+            empty_users_op,
+            client_op(5, 120, ns="local.oplog.rs"),
+            client_op(6, 120, ns="config.transactions"),
+            client_op(7, 120),
+        ]
+
+        event = mock.Mock(params={"seconds-running": 1, "dry-run": False})
+        self.charm.diagnostics._on_kill_ops(event)
+
+        mongo.kill_op.assert_called_once_with(7)
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["count"], 1)
+
+    def test_index_report(self):
+        """Verifies access counts are merged across members before flagging indexes."""
+        member_stats = [
+            index_stats("_id_", {"_id": 1}, 0),
+            index_stats("status_1", {"status": 1}, 0),
+            index_stats("status_1_date_1", {"status": 1, "date": -1}, 0),
+            index_stats("notes_text", {"_fts": "text", "_ftsx": 1}, 3),
+        ]
+        secondary_stats = [
+            index_stats("_id_", {"_id": 1}, 0),
+            index_stats("status_1", {"status": 1}, 0),
+            index_stats("status_1_date_1", {"status": 1, "date": -1}, 7),
+            index_stats("notes_text", {"_fts": "text", "_ftsx": 1}, 0),
+        ]
+
+        report = build_index_report(
+            {("shop", "orders"): ORDERS_STATS},
+            {("shop", "orders"): member_stats + secondary_stats},
+            1.0,
+        )["shop"]
+
+        self.assertEqual(report["indexes"], 4)
+        self.assertEqual(report["unused"], ["orders.status_1"])
+        self.assertEqual(
+            report["duplicate-prefix"], ["orders.status_1 (prefix of status_1_date_1)"]
+        )
+        self.assertEqual(report["oversized"], ["orders.notes_text"])
+        self.assertEqual(report["flagged-indexes"], 2)
+        self.assertEqual(report["flagged-index-bytes"], 1550)
+        self.assertEqual(report["extra-index-writes"], 20)
+
+    def test_index_report_unique_prefix(self):
+        """Verifies unique indexes are not reported as duplicates of longer indexes."""
+        report = build_index_report(
+            {("shop", "orders"): ORDERS_STATS},
+            {
+                ("shop", "orders"): [
+                    index_stats("status_1", {"status": 1}, 1, unique=True),
+                    index_stats("status_1_date_1", {"status": 1, "date": -1}, 1),
+                    index_stats("status_-1", {"status": -1}, 1),
+                ]
+            },
+            1.0,
+        )["shop"]
+
+        self.assertEqual(report["duplicate-prefix"], [])
+        self.assertEqual(report["flagged-indexes"], 0)
+
+    def test_index_report_empty_collection(self):
+        """Verifies indexes of collections holding no data are not reported as oversized."""
+        report = build_index_report(
+            {("shop", "carts"): {"storageStats": {"size": 0, "indexSizes": {"user_1": 4096}}}},
+            {("shop", "carts"): [index_stats("user_1", {"user": 1}, 3)]},
+            1.0,
+        )["shop"]
+
+        self.assertEqual(report["oversized"], [])
+        self.assertEqual(report["flagged-indexes"], 0)
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_index_report_action(self, connection):
+        """Verifies index statistics are collected from every member."""
+        self.harness.add_relation_unit(
+            self.harness.model.get_relation("database-peers").id, "mongodb-k8s/1"
+        )
+        relation_id = self.harness.add_relation("database", "consumer")
+        self.harness.update_relation_data(relation_id, "consumer", {"database": "shop"})
+        mongo = connection.return_value.__enter__.return_value
+        mongo.get_databases.return_value = {"shop"}
+        mongo.get_collections.return_value = ["orders"]
+        mongo.get_collection_stats.return_value = ORDERS_STATS
+        mongo.get_index_stats.return_value = [index_stats("status_1", {"status": 1}, 0)]
+
+        event = mock.Mock(params={"oversized-ratio": 1.0})
+        self.charm.diagnostics._on_get_index_report(event)
+
+        self.assertEqual(mongo.get_index_stats.call_count, 2)
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["members"], 2)
+        self.assertEqual(results["databases"]["0"]["name"], "shop")
+        self.assertEqual(results["databases"]["0"]["relation-id"], relation_id)
+        self.assertEqual(results["databases"]["0"]["unused"], "orders.status_1")
+        self.assertEqual(results["summary"]["flagged-indexes"], 1)
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_index_report_action_member_failure(self, connection):
+        mongo = connection.return_value.__enter__.return_value
+        mongo.get_databases.return_value = {"shop"}
+        mongo.get_collections.return_value = ["orders"]
+        mongo.get_index_stats.side_effect = ConnectionFailure("error message")
+
+        event = mock.Mock(params={"oversized-ratio": 1.0})
+        self.charm.diagnostics._on_get_index_report(event)
+
+        event.fail.assert_called()
+        event.set_results.assert_not_called()
+
+    def test_storage_report(self):
+        """Verifies reusable bytes of collection and index files are summed up."""
+        stats = {
+            "storageStats": {
+                "size": 1000,
+                "storageSize": 4000,
+                "totalIndexSize": 1000,
+                "wiredTiger": {"block-manager": {"file bytes available for reuse": 2000}},
+                "indexDetails": {
+                    "_id_": {"block-manager": {"file bytes available for reuse": 400}},
+                    "status_1": {"block-manager": {"file bytes available for reuse": 100}},
+                },
+            }
+        }
+
+        report = build_storage_report({("shop", "orders"): stats, ("shop", "users"): {}})
+
+        self.assertEqual(report["shop"]["reusable-bytes"], 2500)
+        self.assertEqual(report["shop"]["storage-size"], 4000)
+        orders = report["shop"]["collections"]["0"]
+        self.assertEqual(orders["name"], "orders")
+        self.assertEqual(orders["reusable-ratio"], 0.5)
+        self.assertEqual(report["shop"]["collections"]["1"]["reusable-ratio"], 0)
+
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_compact(self, connection):
+        """Verifies secondaries are compacted first and the primary after stepping down."""
+        self.harness.set_leader(True)
+        self.harness.add_relation_unit(
+            self.harness.model.get_relation("database-peers").id, "mongodb-k8s/1"
+        )
+        primary = self.charm.get_hostname_by_unit("mongodb-k8s/0")
+        secondary = self.charm.get_hostname_by_unit("mongodb-k8s/1")
+        mongo = connection.return_value.__enter__.return_value
+        mongo.primary.return_value = primary
+        mongo.get_databases.return_value = {"shop"}
+        mongo.get_collections.return_value = ["orders"]
+        mongo.compact.return_value = {"ok": 1, "bytesFreed": 100}
+        mongo.get_replset_status.return_value = {primary: "SECONDARY", secondary: "SECONDARY"}
+        mongo.get_replication_lag.return_value = {primary: 0, secondary: 0}
+
+        event = mock.Mock(params={})
+        self.charm.diagnostics._on_compact(event)
+
+        compacted_hosts = [
+            config[0].hosts for config, kwargs in connection.call_args_list if kwargs.get("direct")
+        ]
+        self.assertEqual(compacted_hosts, [{secondary}, {primary}])
+        mongo.step_down.assert_called_once()
+        results = event.set_results.call_args[0][0]
+        self.assertEqual(results["bytes-freed"], 200)
+        self.assertEqual(results["members"]["0"]["host"], secondary)
+
+    @patch(f"{DIAGNOSTICS_MODULE}.Retrying")
+    @patch(f"{DIAGNOSTICS_MODULE}.MongoDBConnection")
+    def test_compact_member_not_catching_up(self, connection, retrying):
+        """Verifies compaction stops when a member does not catch up with the primary."""
+        self.harness.set_leader(True)
+        self.harness.add_relation_unit(
+            self.harness.model.get_relation("database-peers").id, "mongodb-k8s/1"
+        )
+        primary = self.charm.get_hostname_by_unit("mongodb-k8s/0")
+        retrying.side_effect = RetryError(None)
+        mongo = connection.return_value.__enter__.return_value
+        mongo.primary.return_value = primary
+        mongo.get_databases.return_value = {"shop"}
+        mongo.get_collections.return_value = ["orders"]
+
+        event = mock.Mock(params={})
+        self.charm.diagnostics._on_compact(event)
+
+        event.fail.assert_called()
+        mongo.step_down.assert_not_called()
+
+    def test_compact_not_leader(self):
+        event = mock.Mock(params={})
+        self.charm.diagnostics._on_compact(event)
+
+        event.fail.assert_called()
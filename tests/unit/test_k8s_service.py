@@ -0,0 +1,69 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import httpx
+from lightkube.core.exceptions import ApiError
+from lightkube.models.core_v1 import ServicePort, ServiceSpec
+from lightkube.resources.core_v1 import Service
+
+from k8s_service import add_srv_port, get_cluster_domain
+
+
+class TestK8sService(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.resolv_conf = os.path.join(self.tmpdir.name, "resolv.conf")
+
+    def test_cluster_domain(self):
+        """Verifies the cluster domain is read from the search domains of the pod."""
+        with open(self.resolv_conf, "w") as f:
+            f.write(
+                "nameserver 10.152.183.10\n"
+                "search dev.svc.k8s.example.com svc.k8s.example.com k8s.example.com\n"
+                "options ndots:5\n"
+            )
+        self.assertEqual(get_cluster_domain(self.resolv_conf), "k8s.example.com")
+
+    def test_cluster_domain_unknown(self):
+        self.assertIsNone(get_cluster_domain(self.resolv_conf))
+
+        with open(self.resolv_conf, "w") as f:
+            f.write("nameserver 10.152.183.10\nsearch example.com\n")
+        self.assertIsNone(get_cluster_domain(self.resolv_conf))
+
+    @patch("k8s_service.Client")
+    def test_add_srv_port(self, client):
+        """Verifies the mongodb port is merged into the service ports once."""
+        client.return_value.get.return_value = Service(
+            spec=ServiceSpec(ports=[ServicePort(name="placeholder", port=65535)])
+        )
+
+        self.assertTrue(add_srv_port("mongodb-k8s-endpoints", "dev", 27017))
+        patch_kwargs = client.return_value.patch.call_args[1]
+        self.assertEqual(patch_kwargs["name"], "mongodb-k8s-endpoints")
+        self.assertEqual(patch_kwargs["namespace"], "dev")
+        self.assertEqual(
+            patch_kwargs["obj"]["spec"]["ports"],
+            [{"name": "mongodb", "port": 27017, "targetPort": 27017, "protocol": "TCP"}],
+        )
+
+        client.return_value.patch.reset_mock()
+        client.return_value.get.return_value.spec.ports.append(
+            ServicePort(name="mongodb", port=27017)
+        )
+        self.assertTrue(add_srv_port("mongodb-k8s-endpoints", "dev", 27017))
+        client.return_value.patch.assert_not_called()
+
+    @patch("k8s_service.Client")
+    def test_add_srv_port_forbidden(self, client):
+        """Verifies untrusted applications report the service has no mongodb port."""
+        response = httpx.Response(403, json={"code": 403, "message": "forbidden"})
+        client.return_value.get.side_effect = ApiError(response=response)
+
+        self.assertFalse(add_srv_port("mongodb-k8s-endpoints", "dev", 27017))
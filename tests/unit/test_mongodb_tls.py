@@ -0,0 +1,72 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest.mock import patch
+
+from charms.tls_certificates_interface.v1.tls_certificates import generate_private_key
+from ops.testing import Harness
+
+from charm import MongoDBCharm
+from tests.unit.helpers import patch_network_get
+
+
+class TestMongoDBTLS(unittest.TestCase):
+    @patch_network_get(private_address="1.1.1.1")
+    def setUp(self):
+        self.harness = Harness(MongoDBCharm)
+        mongo_resource = {
+            "registrypath": "mongo:4.4",
+        }
+        self.harness.add_oci_resource("mongodb-image", mongo_resource)
+        self.harness.begin()
+        self.harness.add_relation("database-peers", "mongodb-peers")
+        self.harness.set_leader(True)
+        self.charm = self.harness.charm
+        self.addCleanup(self.harness.cleanup)
+
+    @patch_network_get(private_address="1.1.1.1")
+    def test_key_pool(self):
+        """Verifies pre-generated keys are used for CSRs and refilled on update-status."""
+        self.harness.update_config({"key-type": "ecdsa-p256", "key-pool-size": 2})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(len(self.charm.tls._stored.key_pool), 2)
+        pooled_keys = list(self.charm.tls._stored.key_pool)
+
+        with patch(
+            "charms.mongodb.v0.mongodb_tls.generate_private_key", wraps=generate_private_key
+        ) as generate:
+            rel_id = self.harness.add_relation("certificates", "tls-certificates-operator")
+            self.harness.add_relation_unit(rel_id, "tls-certificates-operator/0")
+            generate.assert_not_called()
+        self.assertEqual(len(self.charm.tls._stored.key_pool), 0)
+        self.assertIn(self.charm.get_secret("unit", "key"), pooled_keys)
+        self.assertIn(self.charm.get_secret("app", "key"), pooled_keys)
+
+        # keys are generated in the hook once the pool is empty
+        with patch(
+            "charms.mongodb.v0.mongodb_tls.generate_private_key", wraps=generate_private_key
+        ) as generate:
+            self.charm.tls._request_certificate("unit", None)
+            generate.assert_called_once()
+
+    @patch_network_get(private_address="1.1.1.1")
+    def test_key_pool_follows_config(self):
+        """Verifies keys of another type are discarded and the pool shrinks with its size."""
+        self.harness.update_config({"key-type": "ecdsa-p256", "key-pool-size": 2})
+        self.harness.charm.on.update_status.emit()
+
+        self.harness.update_config({"key-type": "ecdsa-p384"})
+        self.assertIsNone(self.charm.tls._get_pooled_key())
+
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.charm.tls._stored.key_pool_type, "ecdsa-p384")
+        self.assertEqual(len(self.charm.tls._stored.key_pool), 2)
+
+        self.harness.update_config({"key-pool-size": 1})
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(len(self.charm.tls._stored.key_pool), 1)
+
+    def test_key_pool_disabled_by_default(self):
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(len(self.charm.tls._stored.key_pool), 0)
@@ -0,0 +1,76 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import pstats
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from profiling import list_profiles, profile_hook, read_profile, set_profiling_threshold
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.directory = os.path.join(self.tmpdir.name, "hook-profiles")
+
+    def test_profiling_disabled_by_default(self):
+        with profile_hook(self.directory):
+            sum(range(1000))
+        self.assertEqual(list_profiles(self.directory), [])
+
+    @patch.dict(os.environ, {"JUJU_DISPATCH_PATH": "hooks/update-status"})
+    def test_only_slow_hooks_are_kept(self):
+        """Verifies a profile is saved only when the hook passed the duration threshold."""
+        set_profiling_threshold(self.directory, 60)
+        with profile_hook(self.directory):
+            sum(range(1000))
+        self.assertEqual(list_profiles(self.directory), [])
+
+        set_profiling_threshold(self.directory, 0.000001)
+        with profile_hook(self.directory):
+            sum(range(1000))
+        profiles = list_profiles(self.directory)
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]["hook"], "update-status")
+
+        # the saved file is a valid pstats dump
+        path = os.path.join(self.directory, profiles[0]["name"])
+        pstats.Stats(path)
+        self.assertTrue(read_profile(self.directory, profiles[0]["name"]))
+
+        # disabling removes the threshold but keeps recorded profiles
+        set_profiling_threshold(self.directory, 0)
+        with profile_hook(self.directory):
+            sum(range(1000))
+        self.assertEqual(len(list_profiles(self.directory)), 1)
+
+    @patch("profiling.MAX_PROFILES", 3)
+    @patch("profiling.time.time")
+    def test_profiles_rotated(self, unix_time):
+        """Verifies only the most recent profiles are kept."""
+        set_profiling_threshold(self.directory, 0.000001)
+        for timestamp in range(1000, 1005):
+            unix_time.return_value = timestamp
+            with profile_hook(self.directory):
+                sum(range(1000))
+
+        timestamps = [profile["timestamp"] for profile in list_profiles(self.directory)]
+        self.assertEqual(timestamps, [1004, 1003, 1002])
+
+    @patch.dict(os.environ, {"JUJU_DISPATCH_PATH": "hooks/update-status"})
+    def test_foreign_files_ignored(self):
+        """Verifies files not named like profiles do not break hooks."""
+        set_profiling_threshold(self.directory, 0.000001)
+        with open(os.path.join(self.directory, "copy.pstats"), "w") as f:
+            f.write("not a profile")
+
+        with profile_hook(self.directory):
+            sum(range(1000))
+        self.assertEqual([p["hook"] for p in list_profiles(self.directory)], ["update-status"])
+
+    def test_read_unknown_profile(self):
+        with self.assertRaises(ValueError):
+            read_profile(self.directory, "../threshold")
@@ -0,0 +1,221 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+from unittest.mock import patch
+
+from charms.tls_certificates_interface.v1.tls_certificates import (
+    TLSCertificatesProvidesV1,
+    TLSCertificatesRequiresV1,
+    _decode_relation_data,
+    _is_valid,
+    generate_ca,
+    generate_certificate,
+    generate_csr,
+    generate_private_key,
+)
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+from charm import MongoDBCharm
+from tests.unit.helpers import patch_network_get
+
+TLS_MODULE = "charms.tls_certificates_interface.v1.tls_certificates"
+
+
+class TestTLSCertificatesRequires(unittest.TestCase):
+    @patch_network_get(private_address="1.1.1.1")
+    def setUp(self):
+        self.harness = Harness(MongoDBCharm)
+        mongo_resource = {
+            "registrypath": "mongo:4.4",
+        }
+        self.harness.add_oci_resource("mongodb-image", mongo_resource)
+        self.harness.begin()
+        self.harness.add_relation("database-peers", "mongodb-peers")
+        self.relation_id = self.harness.add_relation("certificates", "tls-provider")
+        self.certs = self.harness.charm.tls.certs
+        self.addCleanup(self.harness.cleanup)
+
+    def _set_provider_certificates(self, validity: int) -> str:
+        """Publish a certificate valid for validity days in the provider databag."""
+        ca_key = generate_private_key()
+        ca = generate_ca(ca_key, "ca").decode()
+        csr = generate_csr(generate_private_key(), subject="mongodb-k8s-0")
+        certificate = generate_certificate(csr, ca.encode(), ca_key, validity=validity).decode()
+        certificates = [
+            {
+                "certificate_signing_request": csr.decode(),
+                "certificate": certificate,
+                "ca": ca,
+                "chain": [ca],
+            }
+        ]
+        self.harness.update_relation_data(
+            self.relation_id, "tls-provider", {"certificates": json.dumps(certificates)}
+        )
+        return certificate
+
+    @patch(f"{TLS_MODULE}.TLSCertificatesRequiresV1._relation_data_is_valid")
+    def test_update_status_parses_certificates_once(self, is_valid):
+        """Verifies unchanged certificates far from expiry are not parsed or validated again."""
+        is_valid.return_value = True
+        self._set_provider_certificates(validity=365)
+        is_valid.reset_mock()
+
+        with patch(
+            f"{TLS_MODULE}.x509.load_pem_x509_certificate", wraps=x509.load_pem_x509_certificate
+        ) as load_certificate:
+            self.harness.charm.on.update_status.emit()
+            self.harness.charm.on.update_status.emit()
+
+        load_certificate.assert_called_once()
+        is_valid.assert_called_once()
+        self.assertIsNotNone(self.certs._stored.next_check)
+
+    @patch("charms.mongodb.v0.mongodb_tls.MongoDBTLS._on_certificate_expiring")
+    def test_update_status_reports_expiring_certificates(self, on_certificate_expiring):
+        """Verifies expiring certificates are reported on every update status."""
+        certificate = self._set_provider_certificates(validity=1)
+
+        self.harness.charm.on.update_status.emit()
+        self.harness.charm.on.update_status.emit()
+
+        self.assertEqual(on_certificate_expiring.call_count, 2)
+        event = on_certificate_expiring.call_args[0][0]
+        self.assertEqual(event.certificate, certificate)
+
+    @patch_network_get(private_address="1.1.1.1")
+    def test_ecdsa_private_key(self):
+        """Verifies the key-type option selects the type of generated private keys."""
+        self.harness.update_config({"key-type": "ecdsa-p256"})
+
+        self.harness.charm.tls._request_certificate("unit", None)
+
+        key = serialization.load_pem_private_key(
+            self.harness.charm.get_secret("unit", "key").encode(), password=None
+        )
+        self.assertIsInstance(key, ec.EllipticCurvePrivateKey)
+        self.assertEqual(key.curve.name, "secp256r1")
+        csr = x509.load_pem_x509_csr(self.harness.charm.get_secret("unit", "csr").encode())
+        self.assertTrue(csr.is_signature_valid)
+
+    @patch_network_get(private_address="1.1.1.1")
+    def test_unknown_key_type(self):
+        """Verifies unknown key types fall back to RSA keys."""
+        self.harness.update_config({"key-type": "dsa"})
+
+        self.harness.charm.tls._request_certificate("unit", None)
+
+        key = serialization.load_pem_private_key(
+            self.harness.charm.get_secret("unit", "key").encode(), password=None
+        )
+        self.assertIsInstance(key, rsa.RSAPrivateKey)
+
+    def test_relation_data_validation_memoised(self):
+        """Verifies unchanged relation data is validated once."""
+        _is_valid.cache_clear()
+        data = {"certificates": [{"certificate": "cert"}]}
+
+        self.assertFalse(TLSCertificatesRequiresV1._relation_data_is_valid(data))
+        self.assertFalse(TLSCertificatesRequiresV1._relation_data_is_valid(dict(data)))
+        self.assertTrue(TLSCertificatesRequiresV1._relation_data_is_valid({"certificates": []}))
+
+        cache_info = _is_valid.cache_info()
+        self.assertEqual((cache_info.hits, cache_info.misses), (1, 2))
+
+    def test_relation_data_decoded_once(self):
+        """Verifies CSR and certificate lookups decode each databag content once."""
+        self._set_provider_certificates(validity=365)
+        _decode_relation_data.cache_clear()
+
+        for _ in range(3):
+            self.certs._provider_certificates
+            self.certs._requirer_csrs
+        self.assertEqual(_decode_relation_data.cache_info().misses, 2)
+
+        # changed content is decoded again
+        certificate = self._set_provider_certificates(validity=365)
+        self.assertEqual(self.certs._provider_certificates[0]["certificate"], certificate)
+
+
+class ProviderCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.certificates = TLSCertificatesProvidesV1(self, "certificates")
+        self.revoked_csrs = []
+        self.framework.observe(
+            self.certificates.on.certificate_revocation_request, self._on_revocation_request
+        )
+
+    def _on_revocation_request(self, event):
+        self.revoked_csrs.append(event.certificate_signing_request)
+
+
+class TestTLSCertificatesProvides(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness(
+            ProviderCharm,
+            meta="name: tls-provider\nprovides:\n  certificates:\n    interface: tls",
+        )
+        self.harness.begin()
+        self.harness.set_leader(True)
+        self.relation_id = self.harness.add_relation("certificates", "mongodb-k8s")
+        self.harness.add_relation_unit(self.relation_id, "mongodb-k8s/0")
+        self.certificates = [
+            {"certificate_signing_request": f"csr-{i}", "certificate": f"cert-{i}", "ca": "ca"}
+            for i in range(3)
+        ]
+        for certificate in self.certificates:
+            certificate["chain"] = ["ca"]
+        self.harness.update_relation_data(
+            self.relation_id, "tls-provider", {"certificates": json.dumps(self.certificates)}
+        )
+
+    def _provided_csrs(self):
+        data = self.harness.get_relation_data(self.relation_id, "tls-provider")
+        return [
+            certificate["certificate_signing_request"]
+            for certificate in json.loads(data["certificates"])
+        ]
+
+    def test_certificates_without_csr_revoked(self):
+        """Verifies certificates whose CSR was withdrawn are revoked in one write."""
+        csrs = [{"certificate_signing_request": "csr-1"}, {"certificate_signing_request": "csr-3"}]
+
+        self.harness.update_relation_data(
+            self.relation_id,
+            "mongodb-k8s/0",
+            {"certificate_signing_requests": json.dumps(csrs)},
+        )
+
+        self.assertEqual(self.harness.charm.revoked_csrs, ["csr-0", "csr-2"])
+        self.assertEqual(self._provided_csrs(), ["csr-1"])
+
+    def test_remove_certificate_by_certificate_and_csr(self):
+        """Verifies a certificate matching both arguments is removed once."""
+        self.harness.charm.certificates._remove_certificate(
+            relation_id=self.relation_id, certificate="cert-0", certificate_signing_request="csr-0"
+        )
+        self.assertEqual(self._provided_csrs(), ["csr-1", "csr-2"])
+
+    def test_set_relation_certificates(self):
+        """Verifies certificates are added and replaced by CSR."""
+        self.harness.charm.certificates.set_relation_certificates(
+            [
+                ("csr-1", "new-cert-1", "ca", ["ca"]),
+                ("csr-3", "cert-3", "ca\n", ["ca\n"]),
+                ("csr-4", "cert-4", "ca", ["ca"]),
+            ],
+            relation_id=self.relation_id,
+        )
+
+        self.assertEqual(self._provided_csrs(), ["csr-0", "csr-2", "csr-1", "csr-3", "csr-4"])
+        data = self.harness.get_relation_data(self.relation_id, "tls-provider")
+        certificates = json.loads(data["certificates"])
+        self.assertEqual(certificates[2]["certificate"], "new-cert-1")
+        self.assertEqual(certificates[3]["ca"], "ca")
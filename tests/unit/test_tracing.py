@@ -0,0 +1,126 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from unittest.mock import patch
+
+from tracing import (
+    SPAN_KIND_CLIENT,
+    STATUS_CODE_ERROR,
+    Tracer,
+    _CommandListener,
+    trace_handlers,
+)
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "traces", "hooks.json")
+
+    def _exported_spans(self):
+        with open(self.path) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+        resource_spans = json.loads(lines[0])["resourceSpans"][0]
+        return {
+            span["name"]: span for span in resource_spans["scopeSpans"][0]["spans"]
+        }, resource_spans["resource"]
+
+    def test_disabled_tracer_records_nothing(self):
+        tracer = Tracer()
+        with tracer.span("handler") as span:
+            self.assertIsNone(span)
+        tracer.flush()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_nested_spans_exported_to_file(self):
+        """Verifies spans are exported once per hook with parents pointing to enclosing spans."""
+        tracer = Tracer()
+        tracer.enable(f"file://{self.path}", {"service.name": "mongodb-k8s"}, "start")
+
+        with tracer.span("MongoDBCharm._on_start"):
+            with tracer.span("pebble.push", {"path": "/etc/mongodb/keyFile"}):
+                pass
+        with self.assertRaises(ValueError):
+            with tracer.span("MongoDBCharm._reconfigure"):
+                raise ValueError("boom")
+        tracer.flush()
+
+        spans, resource = self._exported_spans()
+        self.assertEqual(
+            resource["attributes"],
+            [{"key": "service.name", "value": {"stringValue": "mongodb-k8s"}}],
+        )
+        self.assertNotIn("parentSpanId", spans["start"])
+        self.assertEqual(spans["MongoDBCharm._on_start"]["parentSpanId"], spans["start"]["spanId"])
+        self.assertEqual(
+            spans["pebble.push"]["parentSpanId"], spans["MongoDBCharm._on_start"]["spanId"]
+        )
+        self.assertEqual(spans["MongoDBCharm._reconfigure"]["status"]["code"], STATUS_CODE_ERROR)
+        self.assertEqual(len({span["traceId"] for span in spans.values()}), 1)
+
+    def test_mongodb_commands_recorded_as_client_spans(self):
+        """Verifies MongoDB commands are traced without recording command documents."""
+        tracer = Tracer()
+        tracer.enable(f"file://{self.path}", {}, "start")
+        listener = _CommandListener(tracer)
+
+        with tracer.span("MongoDBProvider._on_relation_event"):
+            started = mock.Mock(
+                command_name="createUser",
+                database_name="admin",
+                connection_id=("mongodb-k8s-0.mongodb-k8s-endpoints", 27017),
+                request_id=1,
+            )
+            listener.started(started)
+            listener.succeeded(mock.Mock(request_id=1))
+        tracer.flush()
+
+        spans, _ = self._exported_spans()
+        command_span = spans["mongodb.createUser"]
+        self.assertEqual(command_span["kind"], SPAN_KIND_CLIENT)
+        self.assertEqual(
+            command_span["parentSpanId"], spans["MongoDBProvider._on_relation_event"]["spanId"]
+        )
+        self.assertNotIn("pwd", json.dumps(command_span))
+
+    def test_library_handlers_traced(self):
+        """Verifies handlers of charm library objects are recorded as spans."""
+
+        class Manager:
+            def _on_update_status(self, event):
+                return "handled"
+
+        tracer = Tracer()
+        tracer.enable(f"file://{self.path}", {}, "update-status")
+        trace_handlers(Manager)
+        trace_handlers(Manager)
+        with patch("tracing._tracer", tracer):
+            self.assertEqual(Manager()._on_update_status(mock.Mock()), "handled")
+        tracer.flush()
+
+        spans, _ = self._exported_spans()
+        with open(self.path) as f:
+            exported = json.load(f)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        # handlers are wrapped once
+        self.assertEqual(len(exported), 2)
+        self.assertEqual(
+            spans["Manager._on_update_status"]["parentSpanId"], spans["update-status"]["spanId"]
+        )
+
+    @patch("tracing.urllib.request.urlopen")
+    def test_collector_failure_does_not_raise(self, urlopen):
+        """Verifies export errors are logged and do not fail the hook."""
+        urlopen.side_effect = OSError("connection refused")
+        tracer = Tracer()
+        tracer.enable("http://collector:4318", {}, "update-status")
+        tracer.flush()
+
+        request = urlopen.call_args[0][0]
+        self.assertEqual(request.full_url, "http://collector:4318/v1/traces")